@@ -0,0 +1,107 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import perf_counter, sleep
+from urllib.parse import parse_qs, urlparse
+from os import path
+import wanikani
+from wanikani import WaniKaniHandler
+
+# Benchmark of a cold WaniKaniHandler.download_all_data against a local stub of the WaniKani API that adds a fixed
+# latency to every page, comparing the concurrent crawl with the four collections crawled one after another.
+# Runs offline. Run with "python3 benchmark_crawl.py"
+_PAGE_LATENCY = 0.05  # Seconds the stub waits before answering each page
+_PAGE_SIZE = 100
+_COLLECTION_SIZES = {  # Records per collection, kept under the rate limiter's 60-request burst in total
+    "subjects?types=kanji": 1_000,
+    "subjects?types=vocabulary,kana_vocabulary": 2_000,
+    "assignments?subject_types=kanji": 500,
+    "assignments?subject_types=vocabulary,kana_vocabulary": 1_000
+}
+_REPEATS = 3
+
+
+class StubWaniKaniHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *arguments):
+        pass
+
+
+    def do_GET(self):
+        """
+        Answers a page of a collection after _PAGE_LATENCY, with made-up subjects and assignments
+        """
+        sleep(_PAGE_LATENCY)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        page = int(query.pop("page", ["0"])[0])
+        endpoint = url.path.rsplit("/", 1)[-1]
+        collection_key = endpoint + "?" + "&".join("%s=%s" % (key, values[0]) for key, values in query.items())
+        collection_size = _COLLECTION_SIZES[collection_key]
+        first_id = 1 if "kanji" in collection_key.split("=")[1].split(",") else 10_000
+        record_ids = range(first_id + page * _PAGE_SIZE, first_id + min((page + 1) * _PAGE_SIZE, collection_size))
+        if endpoint == "subjects":
+            records = [{"id": record_id, "data": {"characters": chr(0x4E00 + record_id)}} for record_id in record_ids]
+        else:
+            records = [{"id": record_id, "data": {"subject_id": record_id, "srs_stage": record_id % 10}} for record_id in record_ids]
+        next_url = None
+        if (page + 1) * _PAGE_SIZE < collection_size:
+            next_url = "http://%s:%d%s?%s&page=%d" % (*self.server.server_address, url.path, url.query.split("&page=")[0], page + 1)
+
+        body = dumps({"data": records, "pages": {"next_url": next_url}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def run_downloads_in_sequence(downloads: dict) -> None:
+    """
+    The one-collection-at-a-time crawl that WaniKaniHandler._run_downloads replaced, kept for comparison
+    """
+    for name, download in downloads.items():
+        download()
+        print("Downloaded %s" % name)
+
+
+def time_cold_sync(run_name: str, sequential: bool) -> float:
+    """
+    Times download_all_data with empty caches, keeping the best of _REPEATS runs.
+    Every run uses its own API token, so it starts with a full rate limiter bucket
+    :param run_name: name of the run, used in the API tokens
+    :param sequential: crawl the collections one after another instead of concurrently
+    :return: Best time in seconds
+    """
+    best_time = None
+    for repeat in range(_REPEATS):
+        with TemporaryDirectory() as cache_directory:
+            wk_handler = WaniKaniHandler(
+                "%s-%d" % (run_name, repeat),
+                cache_file=path.join(cache_directory, "WaniKani_Cache.sqlite"),
+                catalog_file=path.join(cache_directory, "WaniKani_Subjects.sqlite")
+            )
+            if sequential:
+                wk_handler._run_downloads = run_downloads_in_sequence
+            start_time = perf_counter()
+            wk_handler.download_all_data()
+            elapsed_time = perf_counter() - start_time
+        best_time = elapsed_time if best_time is None else min(best_time, elapsed_time)
+    return best_time
+
+
+if __name__ == "__main__":
+    stub_server = ThreadingHTTPServer(("127.0.0.1", 0), StubWaniKaniHandler)
+    Thread(target=stub_server.serve_forever, daemon=True).start()
+    wanikani._WANIKANI_API_URL = "http://127.0.0.1:%d/v2/" % stub_server.server_port
+
+    page_counts = {key: -(-size // _PAGE_SIZE) for key, size in _COLLECTION_SIZES.items()}
+    sequential_time = time_cold_sync("sequential", sequential=True)
+    concurrent_time = time_cold_sync("concurrent", sequential=False)
+    print()
+    print("Pages per collection:", ", ".join("%s: %d" % item for item in page_counts.items()))
+    print("Latency per page: %.0fms" % (_PAGE_LATENCY * 1000))
+    print("Sequential crawl: %.2fs (sum of the collections: %.2fs)" % (sequential_time, sum(page_counts.values()) * _PAGE_LATENCY))
+    print("Concurrent crawl: %.2fs (slowest collection: %.2fs)" % (concurrent_time, max(page_counts.values()) * _PAGE_LATENCY))
+    print("Speedup: %.1fx" % (sequential_time / concurrent_time))
+    stub_server.shutdown()
@@ -0,0 +1,65 @@
+from random import Random
+from time import perf_counter
+from jpdb import diff_vocabulary_ids
+
+# Micro-benchmark of jpdb.diff_vocabulary_ids on synthetic decks. Run with "python3 benchmark_diff.py"
+_DECK_SIZE = 50_000
+_CHANGED_CARDS = 5_000  # Cards added to and removed from the deck
+_LEGACY_DECK_SIZE = 5_000  # The old list scans are O(n*m), so they are only timed on a smaller deck
+
+
+def make_decks(deck_size: int, changed_cards: int, seed: int = 0) -> tuple[list[list], list[list]]:
+    """
+    Builds an old and a new deck of [vid, sid] pairs that share all but changed_cards cards
+    :param deck_size: number of cards in each deck
+    :param changed_cards: number of cards only in the old deck, and number only in the new deck
+    :param seed: seed of the random vids
+    :return: Tuple of (old deck, new deck)
+    """
+    random = Random(seed)
+    vids = random.sample(range(10 * deck_size), deck_size + changed_cards)
+    vocab_ids = [[vid, random.randrange(1 << 31)] for vid in vids]
+    old_deck = vocab_ids[:deck_size]
+    new_deck = vocab_ids[changed_cards:]
+    random.shuffle(new_deck)
+    return old_deck, new_deck
+
+
+def legacy_diff_vocabulary_ids(old_vocab_ids_list: list[list], new_vocab_ids_list: list[list]) -> tuple[list, list]:
+    """
+    The list-in-list scans diff_vocabulary_ids replaced, kept for comparison
+    """
+    word_ids_only_in_new = [word_ids for word_ids in new_vocab_ids_list if word_ids not in old_vocab_ids_list]
+    word_ids_only_in_old = [word_ids for word_ids in old_vocab_ids_list if word_ids not in new_vocab_ids_list]
+    return word_ids_only_in_new, word_ids_only_in_old
+
+
+def time_call(function, *arguments, repeats: int = 5) -> tuple[float, object]:
+    """
+    Times a function, keeping the best of several runs
+    :return: Tuple of (best time in seconds, the function's result)
+    """
+    best_time = None
+    for _ in range(repeats):
+        start_time = perf_counter()
+        result = function(*arguments)
+        elapsed_time = perf_counter() - start_time
+        best_time = elapsed_time if best_time is None else min(best_time, elapsed_time)
+    return best_time, result
+
+
+if __name__ == "__main__":
+    old_deck, new_deck = make_decks(_DECK_SIZE, _CHANGED_CARDS)
+    diff_time, (only_new, only_old, unchanged_count) = time_call(diff_vocabulary_ids, old_deck, new_deck)
+    print("diff_vocabulary_ids, %d cards: %.3fs (%d added, %d removed, %d unchanged)" % (
+        _DECK_SIZE, diff_time, len(only_new), len(only_old), unchanged_count
+    ))
+
+    old_deck, new_deck = make_decks(_LEGACY_DECK_SIZE, _LEGACY_DECK_SIZE // 10)
+    diff_time, (only_new, only_old, _) = time_call(diff_vocabulary_ids, old_deck, new_deck)
+    legacy_time, legacy_result = time_call(legacy_diff_vocabulary_ids, old_deck, new_deck, repeats=1)
+    print("diff_vocabulary_ids, %d cards: %.4fs" % (_LEGACY_DECK_SIZE, diff_time))
+    print("list scans,          %d cards: %.3fs (~%.0fs extrapolated to %d cards)" % (
+        _LEGACY_DECK_SIZE, legacy_time, legacy_time * (_DECK_SIZE / _LEGACY_DECK_SIZE) ** 2, _DECK_SIZE
+    ))
+    print("Same results:", (only_new, only_old) == legacy_result)
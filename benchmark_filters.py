@@ -0,0 +1,114 @@
+from json import load
+from os import path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from waniwords_utility import KANA_LIST, KANA_SET, get_kanji_signature_index
+from wanikani import WaniKaniHandler, FILTER_NAMES
+
+# Benchmark of WaniKaniHandler.filter_words over the whole Frequency_List.json, for a made-up user who knows the
+# most frequent kanji and some of the words made of them. Run with "python3 benchmark_filters.py"
+_KNOWN_KANJI_COUNT = 1_000  # About halfway through WaniKani
+_KNOWN_VOCABULARY_COUNT = 3_000
+_LEVEL_UP_KANJI_COUNT = 30  # Kanji learned on a level up, about a WaniKani level's worth
+_FREQUENCY_LIST_FILE = "Frequency_List.json"
+
+
+def make_known_data(words_list: list[str]) -> tuple[list[str], list[str], list[str]]:
+    """
+    Picks the kanji and vocabulary of the made-up user from the frequency list
+    :param words_list: words in frequency order
+    :return: Tuple of (known kanji, known vocabulary, the next kanji to learn), in frequency order
+    """
+    kanji_list = []
+    for word in words_list:
+        for character in word:
+            if character not in KANA_SET and character not in kanji_list:
+                kanji_list.append(character)
+    known_kanji = kanji_list[:_KNOWN_KANJI_COUNT]
+    known_characters = KANA_SET | frozenset(known_kanji)
+    known_vocabulary = [
+        word for word in words_list if known_characters.issuperset(word) and not KANA_SET.issuperset(word)
+    ][:_KNOWN_VOCABULARY_COUNT]
+    return known_kanji, known_vocabulary, kanji_list[_KNOWN_KANJI_COUNT:_KNOWN_KANJI_COUNT + _LEVEL_UP_KANJI_COUNT]
+
+
+def legacy_filter_words(known_kanji: list[str], known_vocabulary: list[str], words_list: list[str]) -> list[str]:
+    """
+    The list scans that the known-character sets and filter_words replaced, kept for comparison.
+    Applies every filter in turn, each building a new list
+    """
+    new_list_of_words = []
+    for word in words_list:  # filter_out_known_words
+        if word not in known_vocabulary:
+            new_list_of_words.append(word)
+    words_list = new_list_of_words
+
+    new_list_of_words = []
+    for word in words_list:  # filter_out_kana_words
+        for character in word:
+            if character not in KANA_LIST:
+                break
+        else:
+            continue
+        new_list_of_words.append(word)
+    words_list = new_list_of_words
+
+    new_list_of_words = []
+    known_characters = KANA_LIST + known_kanji
+    for word in words_list:  # filter_out_unknown_kanji
+        for character in word:
+            if character not in known_characters:
+                break
+        else:
+            new_list_of_words.append(word)
+    return new_list_of_words
+
+
+def time_call(function, *arguments, repeats: int = 5) -> tuple[float, object]:
+    """
+    Times a function, keeping the best of several runs
+    :return: Tuple of (best time in seconds, the function's result)
+    """
+    best_time = None
+    for _ in range(repeats):
+        start_time = perf_counter()
+        result = function(*arguments)
+        elapsed_time = perf_counter() - start_time
+        best_time = elapsed_time if best_time is None else min(best_time, elapsed_time)
+    return best_time, result
+
+
+if __name__ == "__main__":
+    with open(_FREQUENCY_LIST_FILE, "r", encoding='utf-8') as frequency_list_file:
+        words_list = load(frequency_list_file)
+    known_kanji, known_vocabulary, level_up_kanji = make_known_data(words_list)
+
+    with TemporaryDirectory() as cache_directory:
+        wk_handler = WaniKaniHandler(
+            "benchmark",
+            cache_file=path.join(cache_directory, "WaniKani_Cache.sqlite"),
+            catalog_file=path.join(cache_directory, "WaniKani_Subjects.sqlite")
+        )
+        # Stand in for a download, which would build these from the user's assignments
+        wk_handler._known_vocabulary_set = frozenset(known_vocabulary)
+        wk_handler._known_characters_set = KANA_SET | frozenset(known_kanji)
+
+        # The first pass also finds the frequency list's known words with the kanji signature index
+        first_time, _ = time_call(wk_handler.filter_words, words_list, FILTER_NAMES, repeats=1)
+        filter_time, (filtered_words, _) = time_call(wk_handler.filter_words, words_list, FILTER_NAMES)
+        legacy_time, legacy_words = time_call(legacy_filter_words, known_kanji, known_vocabulary, words_list, repeats=1)
+
+        # After a level up, only the words using the new kanji are checked again
+        build_time, _ = time_call(get_kanji_signature_index().get_known_words, frozenset(known_kanji + level_up_kanji))
+        wk_handler._known_characters_set |= frozenset(level_up_kanji)
+        update_time, _ = time_call(wk_handler._get_known_list_words, frozenset(known_kanji + level_up_kanji), repeats=1)
+        level_up_words, _ = wk_handler.filter_words(words_list, FILTER_NAMES)
+        legacy_level_up_words = legacy_filter_words(known_kanji + level_up_kanji, known_vocabulary, words_list)
+
+    print("%d words, %d known kanji, %d known words" % (len(words_list), len(known_kanji), len(known_vocabulary)))
+    print("filter_words, first pass: %.4fs (loads the kanji signatures)" % first_time)
+    print("filter_words:             %.4fs (%d words kept)" % (filter_time, len(filtered_words)))
+    print("list scans:               %.3fs (%d words kept)" % (legacy_time, len(legacy_words)))
+    print("Speedup: %.0fx" % (legacy_time / filter_time))
+    print("Known words of the list, built: %.4fs, updated for %d new kanji: %.4fs" % (build_time, len(level_up_kanji), update_time))
+    print("Same results:", filtered_words == legacy_words and level_up_words == legacy_level_up_words)
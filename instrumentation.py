@@ -0,0 +1,100 @@
+from contextlib import contextmanager
+from json import dump
+from threading import Lock
+from time import perf_counter
+from typing import Iterator
+
+from requests import Response
+
+from waniwords_utility import atomic_open, get_time
+
+_COUNTERS = ["calls", "wall_time", "requests", "bytes_sent", "bytes_received", "retries", "throttled", "items_in", "items_out"]
+
+
+class Instrumentation:
+    def __init__(self):
+        """
+        Collects timings and counters for each stage of a run: every API endpoint, filter, parse, diff and upload.
+        Stages are named by the code that records them, and counters recorded under the same name add up.
+        Safe to share between the threads of a run
+        """
+        self._stages = {}
+        self._lock = Lock()
+        self._start_time = get_time()
+        self._start_counter = perf_counter()
+
+
+    def add(self, stage_name: str, **counters: float) -> None:
+        """
+        Adds to a stage's counters, creating the stage on first use.
+        A stage only reports the counters that were recorded for it, so a missing counter means "not measured", not 0
+        :param stage_name: name of the stage
+        :param counters: amounts to add, by counter name (see _COUNTERS)
+        """
+        with self._lock:
+            stage_counters = self._stages.setdefault(stage_name, {})
+            for counter, amount in counters.items():
+                if counter not in _COUNTERS:
+                    raise KeyError("Error! Unknown instrumentation counter: %s." % counter)
+                stage_counters[counter] = stage_counters.get(counter, 0) + amount
+
+
+    @contextmanager
+    def stage(self, stage_name: str, items_in: int = None) -> Iterator[dict]:
+        """
+        Times a block of code as one call of a stage
+        :param stage_name: name of the stage
+        :param items_in: number of items going into the stage. Not recorded if None
+        :return: Dictionary of counters (e.g. "items_out") that the block can set, added to the stage at its end
+        """
+        counters = {} if items_in is None else {"items_in": items_in}
+        stage_start_time = perf_counter()
+        try:
+            yield counters
+        finally:
+            self.add(stage_name, calls=1, wall_time=perf_counter() - stage_start_time, **counters)
+
+
+    def record_response(self, stage_name: str, response: Response) -> None:
+        """
+        Counts an HTTP response towards a stage: the request itself, the bytes sent and received,
+        the retries urllib3 made to get it and whether it was throttled
+        :param stage_name: name of the stage, usually the API endpoint
+        :param response: the API's response
+        """
+        retry_state = getattr(response.raw, "retries", None)
+        self.add(
+            stage_name,
+            requests=1,
+            bytes_sent=len(response.request.body or b""),
+            bytes_received=len(response.content),
+            retries=0 if retry_state is None else len(retry_state.history),
+            throttled=1 if response.status_code == 429 else 0
+        )
+
+
+    def get_report(self) -> dict:
+        """
+        Builds a JSON-serializable report of the run so far
+        :return: Dictionary with the run's start time and wall time, and the counters of every stage
+        """
+        with self._lock:
+            stages = {
+                stage_name: {counter: counters[counter] for counter in _COUNTERS if counter in counters}
+                for stage_name, counters in self._stages.items()
+            }
+        return {
+            "start_time": self._start_time,
+            "wall_time": perf_counter() - self._start_counter,
+            "stages": stages
+        }
+
+
+def write_reports(file_name: str, reports: dict[str, dict]) -> None:
+    """
+    Writes instrumentation reports to a JSON file
+    :param file_name: path of the JSON file
+    :param reports: (run name : report from Instrumentation.get_report) of the runs to write
+    """
+    with atomic_open(file_name, "w", encoding='utf-8') as report_file:
+        dump(reports, report_file, indent=3, ensure_ascii=False)
@@ -1,20 +1,75 @@
-from requests import request
-from waniwords_utility import print_list
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from threading import Event
+from typing import Callable, Iterator
+from instrumentation import Instrumentation
+from jpdb_cache import JPDBCache
+from rate_limiter import get_rate_limiter
+from waniwords_utility import print_list, get_token_hash, create_session
+
+_JPDB_API_URL = "https://jpdb.io/api/v1/"
+_JPDB_CACHE_FILE = "JPDB_Cache_%s.sqlite"  # Namespaced by the hash of the API token, as it holds the user's decks
+_JPDB_RATE_LIMIT = 60  # Requests per minute. Not documented, so kept conservative
+_LOOKUP_CHUNK_SIZE = 1000  # Vocabulary ids per lookup-vocabulary request
+_LOOKUP_MAX_IN_FLIGHT = 4
+# Endpoints that create something on every call. A retry after a lost response would create it twice
+_NON_IDEMPOTENT_ENDPOINTS = ["deck/create-empty"]
+_UPLOAD_CHUNK_SIZE = 500  # [vid, sid] pairs per add-vocabulary request
+
+def diff_vocabulary_ids(old_vocab_ids_list: list[list], new_vocab_ids_list: list[list]) -> tuple[list, list, int]:
+    # Compare [vid, sid] pairs as tuples in insertion-ordered dicts. Both output lists keep the order of their input list
+    old_vocab_ids = dict.fromkeys(tuple(word_ids) for word_ids in old_vocab_ids_list)
+    new_vocab_ids = dict.fromkeys(tuple(word_ids) for word_ids in new_vocab_ids_list)
+
+    word_ids_only_in_new = [list(word_ids) for word_ids in new_vocab_ids if word_ids not in old_vocab_ids]
+    word_ids_only_in_old = [list(word_ids) for word_ids in old_vocab_ids if word_ids not in new_vocab_ids]
+    unchanged_count = len(new_vocab_ids) - len(word_ids_only_in_new)
+
+    return (word_ids_only_in_new, word_ids_only_in_old, unchanged_count)
+
 
 class JPDBHandler:
-    def __init__(self, api_token):
+    def __init__(self, api_token, pool_size: int = 4, timeout: float = 60, max_retries: int = 3, cancel_event: Event = None,
+                 cache_file: str = None, instrumentation: Instrumentation = None):
         self._api_token = api_token
+        self._timeout = timeout
+        self._cancel_event = cancel_event  # When set, stops before the next API call with a CancelledError
+        self._session = create_session(
+            pool_size=pool_size,
+            max_retries=max_retries,
+            headers={
+                "Authorization": "Bearer " + api_token
+            }
+        )
+        self._no_retry_session = create_session(
+            pool_size=1,
+            max_retries=0,
+            headers={
+                "Authorization": "Bearer " + api_token
+            }
+        )
+        self._rate_limiter = get_rate_limiter("jpdb", api_token, _JPDB_RATE_LIMIT)
+        # Records the timings and counters of each endpoint, parse, diff and upload
+        self._instrumentation = Instrumentation() if instrumentation is None else instrumentation
+        if cache_file is None:
+            cache_file = _JPDB_CACHE_FILE % get_token_hash(api_token)
+        self._cache = JPDBCache(cache_file)
 
     def _call_api(self, endpoint: str, json: dict):
+        if self._cancel_event is not None and self._cancel_event.is_set():
+            raise CancelledError("Cancelled!")
+        stage_name = "jpdb " + endpoint
         try:
-            response_json = request(
-                method="POST",
-                url="https://jpdb.io/api/v1/" + endpoint,
-                headers={
-                    "Authorization": "Bearer " + self._api_token
-                },
-                json=json,
-            ).json()
+            with self._instrumentation.stage(stage_name):
+                response_json = self._rate_limiter.request(
+                    session=self._no_retry_session if endpoint in _NON_IDEMPOTENT_ENDPOINTS else self._session,
+                    method="POST",
+                    url=_JPDB_API_URL + endpoint,
+                    on_response=lambda response: self._instrumentation.record_response(stage_name, response),
+                    json=json,
+                    timeout=self._timeout
+                ).json()
         except:  # I know, I know... I am sorry
                 print("JDPB Request error!")
                 raise ConnectionError("Error! JDPB API Connection failed. Check your internet connection?")
@@ -32,17 +87,25 @@ class JPDBHandler:
         return response_json
 
 
-    def _get_vocabulary_ids(self, vocabulary_list: list[str]) -> list[list]:
+    def _parse_vocabulary_ids(self, vocabulary_list: list[str]) -> dict[str, list[list]]:
         # Format the vocabulary_list as a newline-separated string for the API call
-        text = ""
+        text = "\n".join(vocabulary_list)
+        # Character offset at which each word starts, to match the parsed tokens back to their word
+        word_starts = []
+        position = 0
         for word in vocabulary_list:
-            text += word + "\n"
+            word_starts.append(position)
+            position += len(word) + 1
 
         vocabulary_ids_dictionary = self._call_api(
             endpoint="parse",
             json={
-                "text": text[:-1],
-                "token_fields": [],
+                "text": text,
+                "position_length_encoding": "utf32",  # Count positions in code points, like Python strings
+                "token_fields": [
+                    "vocabulary_index",
+                    "position"
+                ],
                 "vocabulary_fields": [
                     "vid",  # Vocabulary ID
                     "sid"   # Spelling ID - refers to alternative spellings of a single Vocabulary item
@@ -50,26 +113,57 @@ class JPDBHandler:
             }
         )
 
-        return vocabulary_ids_dictionary["vocabulary"]
+        word_to_vocabulary_ids = {word: [] for word in vocabulary_list}
+        for vocabulary_index, token_position in vocabulary_ids_dictionary["tokens"]:
+            word = vocabulary_list[bisect_right(word_starts, token_position) - 1]
+            vocabulary_ids = vocabulary_ids_dictionary["vocabulary"][vocabulary_index]
+            if vocabulary_ids not in word_to_vocabulary_ids[word]:
+                word_to_vocabulary_ids[word].append(vocabulary_ids)
+        return word_to_vocabulary_ids
+
 
+    def _get_vocabulary_ids(self, vocabulary_list: list[str]) -> list[list]:
+        # Resolve words from the local cache, and only send the ones jpdb hasn't parsed before
+        word_to_vocabulary_ids = self._cache.get_vocabulary_ids(vocabulary_list)
+        uncached_words = [word for word in dict.fromkeys(vocabulary_list) if word not in word_to_vocabulary_ids]
+        if len(uncached_words) > 0:
+            with self._instrumentation.stage("parse", items_in=len(uncached_words)) as stage_counters:
+                parsed_vocabulary_ids = self._parse_vocabulary_ids(uncached_words)
+                stage_counters["items_out"] = sum(len(vocabulary_ids) for vocabulary_ids in parsed_vocabulary_ids.values())
+            self._cache.add_vocabulary_ids(parsed_vocabulary_ids)
+            word_to_vocabulary_ids |= parsed_vocabulary_ids
 
-    def _get_decks(self) -> tuple[list, list]:
+        # Unique [vid, sid] pairs in the order of the words they came from
+        vocabulary_ids_list = []
+        seen_vocabulary_ids = set()
+        for word in vocabulary_list:
+            for vocabulary_ids in word_to_vocabulary_ids[word]:
+                if tuple(vocabulary_ids) not in seen_vocabulary_ids:
+                    seen_vocabulary_ids.add(tuple(vocabulary_ids))
+                    vocabulary_ids_list.append(vocabulary_ids)
+        return vocabulary_ids_list
+
+
+    def _get_decks(self) -> tuple[list, list, list]:
         decks_dictionary = self._call_api(
             endpoint="list-user-decks",
             json={
                 "fields": [
                     "name",
-                    "id"
+                    "id",
+                    "vocabulary_count"
                 ]
             }
         )
         deck_names_list = []
         deck_ids_list = []
+        deck_sizes_list = []
         for deck_data in decks_dictionary["decks"]:
             deck_names_list.append(deck_data[0])
             deck_ids_list.append(deck_data[1])
+            deck_sizes_list.append(deck_data[2])
 
-        return deck_names_list, deck_ids_list
+        return deck_names_list, deck_ids_list, deck_sizes_list
 
 
     def _create_deck(self, deck_name: str, deck_position: int = 0) -> int:
@@ -83,19 +177,17 @@ class JPDBHandler:
         return deck_dictionary["id"]
 
 
-    def _get_differences(self, deck_id: int, new_vocab_ids_list: list[list]) -> tuple[list, list]:
-        old_vocab_ids_list = self._get_deck_vocabulary(deck_id)
-        word_ids_only_in_new = []
-        for word_ids in new_vocab_ids_list:
-            if word_ids not in old_vocab_ids_list:
-                word_ids_only_in_new.append(word_ids)
-        
-        word_ids_only_in_old = []
-        for word_ids in old_vocab_ids_list:
-            if word_ids not in new_vocab_ids_list:
-                word_ids_only_in_old.append(word_ids)
-        
-        return (word_ids_only_in_new, word_ids_only_in_old)
+    def _get_differences(self, deck_id: int, deck_size: int, new_vocab_ids_list: list[list],
+                         refresh_deck: bool = False) -> tuple[list, list, int]:
+        # Use the locally cached deck contents, unless asked not to or the deck's size on jpdb doesn't match them
+        old_vocab_ids_list = self._cache.get_deck_vocabulary(deck_id)
+        if refresh_deck or old_vocab_ids_list is None or len(old_vocab_ids_list) != deck_size:
+            old_vocab_ids_list = self._get_deck_vocabulary(deck_id)
+            self._cache.set_deck_vocabulary(deck_id, old_vocab_ids_list)
+        with self._instrumentation.stage("diff", items_in=len(old_vocab_ids_list) + len(new_vocab_ids_list)) as stage_counters:
+            differences = diff_vocabulary_ids(old_vocab_ids_list, new_vocab_ids_list)
+            stage_counters["items_out"] = len(differences[0]) + len(differences[1])
+        return differences
         
 
     def _get_deck_vocabulary(self, deck_id: int) -> list[int]:
@@ -109,7 +201,7 @@ class JPDBHandler:
         return vocabulary_ids_dictionary["vocabulary"]
 
 
-    def _get_vocabulary_spellings(self, vocabulary_ids_list) -> list[str]:
+    def _lookup_vocabulary_spellings(self, vocabulary_ids_list: list[list]) -> list[str]:
         vocabulary_spellings_dictionary = self._call_api(
             endpoint="lookup-vocabulary",
             json={
@@ -123,6 +215,39 @@ class JPDBHandler:
         return vocabulary_spellings_list
 
 
+    def _iter_vocabulary_spellings(self, vocabulary_ids_list: list[list], chunk_size: int = _LOOKUP_CHUNK_SIZE,
+                                   max_in_flight: int = _LOOKUP_MAX_IN_FLIGHT) -> Iterator[str]:
+        # Look up the ids in bounded chunks, a few at a time, and yield the spellings in input order.
+        # Only max_in_flight chunks of responses are ever held in memory
+        with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+            in_flight = deque()
+            for chunk_start in range(0, len(vocabulary_ids_list), chunk_size):
+                in_flight.append(executor.submit(
+                    self._lookup_vocabulary_spellings, vocabulary_ids_list[chunk_start:chunk_start+chunk_size]
+                ))
+                if len(in_flight) == max_in_flight:
+                    yield from in_flight.popleft().result()
+            while in_flight:
+                yield from in_flight.popleft().result()
+
+
+    def _get_vocabulary_spellings(self, vocabulary_ids_list: list[list]) -> list[str]:
+        # Only look up the spellings that aren't cached locally yet
+        spellings_dictionary = self._cache.get_vocabulary_spellings(vocabulary_ids_list)
+        uncached_vocabulary_ids = [
+            list(vocabulary_ids) for vocabulary_ids in dict.fromkeys(tuple(vocabulary_ids) for vocabulary_ids in vocabulary_ids_list)
+            if vocabulary_ids not in spellings_dictionary
+        ]
+        if len(uncached_vocabulary_ids) > 0:
+            looked_up_spellings = dict(zip(
+                (tuple(vocabulary_ids) for vocabulary_ids in uncached_vocabulary_ids),
+                self._iter_vocabulary_spellings(uncached_vocabulary_ids)
+            ))
+            self._cache.add_vocabulary_spellings(looked_up_spellings)
+            spellings_dictionary |= looked_up_spellings
+        return [spellings_dictionary[tuple(vocabulary_ids)] for vocabulary_ids in vocabulary_ids_list]
+
+
     def _add_vocabulary_to_deck(self, deck_id: int, vocabulary_ids_list: list[list]) -> None:
         self._call_api(
             endpoint="deck/add-vocabulary",
@@ -134,25 +259,61 @@ class JPDBHandler:
         )
 
 
-    def add_vocabulary_to_waniwords_deck(self, words_list: list[str], deck_name: str = "WaniWords") -> int:
+    def _upload_vocabulary_to_deck(self, deck_id: int, vocabulary_ids_list: list[list],
+                                   report_progress: Callable[[int, int], None] = None,
+                                   chunk_size: int = _UPLOAD_CHUNK_SIZE) -> None:
+        # Add the pairs in bounded chunks, one after the other: jpdb appends cards in the order the requests land,
+        # so concurrent chunks could break the deck's frequency order. Each chunk is recorded in the deck cache as soon
+        # as jpdb acknowledges it, so after a failure the next run's diff only re-sends the chunks that didn't land
+        uploaded_count = 0
+        with self._instrumentation.stage("upload", items_in=len(vocabulary_ids_list)) as stage_counters:
+            stage_counters["items_out"] = 0
+            for chunk_start in range(0, len(vocabulary_ids_list), chunk_size):
+                chunk = vocabulary_ids_list[chunk_start:chunk_start+chunk_size]
+                try:
+                    self._add_vocabulary_to_deck(deck_id, chunk)
+                except (KeyError, ConnectionError, CancelledError):
+                    print("%d of %d Vocabulary Words were added before the upload failed. Run again to add the rest." % (
+                        uploaded_count, len(vocabulary_ids_list)
+                    ))
+                    raise
+                self._cache.add_deck_vocabulary(deck_id, chunk)
+                uploaded_count += len(chunk)
+                stage_counters["items_out"] = uploaded_count
+                if report_progress is not None:
+                    report_progress(uploaded_count, len(vocabulary_ids_list))
+
+
+    def add_vocabulary_to_waniwords_deck(self, words_list: list[str], deck_name: str = "WaniWords",
+                                         refresh_deck: bool = False, report_progress: Callable[[int, int], None] = None) -> int:
+        # report_progress is called with (words added so far, words to add) as each chunk of the upload lands
         vocabulary_ids_list = self._get_vocabulary_ids(words_list)
-        deck_names_list, deck_ids_list = self._get_decks()
+        deck_names_list, deck_ids_list, deck_sizes_list = self._get_decks()
         try:  # Get the deck id of the WaniWords deck from the list of decks
             waniwords_deck_index = deck_names_list.index(deck_name)
             print("Existing \"%s\" deck found!" % deck_name)
             waniwords_deck_id = deck_ids_list[waniwords_deck_index]
+            waniwords_deck_size = deck_sizes_list[waniwords_deck_index]
             found_waniwords_deck = True
         except ValueError:
             print("Existing \"%s\" deck NOT found! Creating Deck..." % deck_name)
             waniwords_deck_id = self._create_deck(deck_name=deck_name)
+            waniwords_deck_size = 0
+            self._cache.set_deck_vocabulary(waniwords_deck_id, [])  # A new deck is known to be empty
             found_waniwords_deck = False
         
-        new_word_ids, obsolete_word_ids = self._get_differences(waniwords_deck_id, vocabulary_ids_list)
+        new_word_ids, obsolete_word_ids, unchanged_count = self._get_differences(
+            waniwords_deck_id, waniwords_deck_size, vocabulary_ids_list, refresh_deck
+        )
         if found_waniwords_deck:
+            print("%d Vocabulary Words unchanged." % unchanged_count)
+            # Look up both lists together, so uncached spellings cost at most one request
+            spellings_list = self._get_vocabulary_spellings(new_word_ids + obsolete_word_ids)
             print("Added Vocabulary Words:")
-            print_list(self._get_vocabulary_spellings(new_word_ids))
+            print_list(spellings_list[:len(new_word_ids)])
             print("Obsolete Vocabulary Words:")
-            print_list(self._get_vocabulary_spellings(obsolete_word_ids))
+            print_list(spellings_list[len(new_word_ids):])
 
-        self._add_vocabulary_to_deck(waniwords_deck_id, new_word_ids)
+        if len(new_word_ids) > 0:
+            self._upload_vocabulary_to_deck(waniwords_deck_id, new_word_ids, report_progress)
         return len(new_word_ids)
@@ -0,0 +1,161 @@
+from json import dumps, loads
+from sqlite3 import connect
+from threading import Lock
+
+_LOCK_TIMEOUT = 30  # Seconds to wait for another process to release the database
+
+# Bump whenever the schema or the meaning of the stored data changes. Older caches are then discarded
+_SCHEMA_VERSION = 2
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS vocabulary_ids (
+    spelling        TEXT PRIMARY KEY,
+    vocabulary_ids  TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS vocabulary_spellings (
+    vid         INTEGER NOT NULL,
+    sid         INTEGER NOT NULL,
+    spelling    TEXT NOT NULL,
+    PRIMARY KEY (vid, sid)
+);
+
+CREATE TABLE IF NOT EXISTS decks (
+    deck_id     INTEGER PRIMARY KEY
+);
+
+CREATE TABLE IF NOT EXISTS deck_vocabulary (
+    deck_id     INTEGER NOT NULL,
+    vid         INTEGER NOT NULL,
+    sid         INTEGER NOT NULL,
+    PRIMARY KEY (deck_id, vid, sid)
+);
+"""
+_TABLES = ["vocabulary_ids", "vocabulary_spellings", "decks", "deck_vocabulary"]
+
+
+class JPDBCache:
+    def __init__(self, cache_file: str):
+        """
+        SQLite store for data that jpdb always answers the same way, so it only has to be asked once.
+        Holds the [vid, sid] pairs that each spelling was resolved to by jpdb's parser, the spelling of each [vid, sid] pair,
+        and the last known contents of the user's decks
+        :param cache_file: path of the SQLite database. Created if it doesn't exist
+        """
+        # Other processes may use the same file: wait for their locks, and let readers run alongside a writer
+        self._connection = connect(cache_file, timeout=_LOCK_TIMEOUT, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._lock = Lock()  # The connection is shared by concurrent batches
+        with self._lock, self._connection:
+            schema_version = self._connection.execute("PRAGMA user_version").fetchone()[0]
+            if schema_version != _SCHEMA_VERSION:
+                if schema_version != 0:
+                    print("JPDB cache is from another version. Ignoring cache contents.")
+                for table in _TABLES:
+                    self._connection.execute("DROP TABLE IF EXISTS %s" % table)
+                self._connection.execute("PRAGMA user_version = %d" % _SCHEMA_VERSION)
+            self._connection.executescript(_SCHEMA)
+
+
+    def get_vocabulary_ids(self, spellings: list[str]) -> dict[str, list[list]]:
+        """
+        Gets the cached parser results of the given spellings
+        :param spellings: spellings to look up
+        :return: Dictionary of (spelling : list of [vid, sid] pairs) for the spellings that were cached
+        """
+        vocabulary_ids_dictionary = {}
+        with self._lock:
+            for spelling in spellings:
+                row = self._connection.execute(
+                    "SELECT vocabulary_ids FROM vocabulary_ids WHERE spelling = ?",
+                    (spelling,)
+                ).fetchone()
+                if row is not None:
+                    vocabulary_ids_dictionary[spelling] = loads(row[0])
+        return vocabulary_ids_dictionary
+
+
+    def add_vocabulary_ids(self, vocabulary_ids_dictionary: dict[str, list[list]]) -> None:
+        """
+        Stores parser results in a single transaction
+        :param vocabulary_ids_dictionary: Dictionary of (spelling : list of [vid, sid] pairs)
+        """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO vocabulary_ids (spelling, vocabulary_ids) VALUES (?, ?)",
+                ((spelling, dumps(vocabulary_ids)) for spelling, vocabulary_ids in vocabulary_ids_dictionary.items())
+            )
+
+
+    def get_vocabulary_spellings(self, vocabulary_ids_list: list[list]) -> dict[tuple[int, int], str]:
+        """
+        Gets the cached spellings of the given [vid, sid] pairs
+        :param vocabulary_ids_list: [vid, sid] pairs to look up
+        :return: Dictionary of ((vid, sid) : spelling) for the pairs that were cached
+        """
+        spellings_dictionary = {}
+        with self._lock:
+            for vid, sid in vocabulary_ids_list:
+                row = self._connection.execute(
+                    "SELECT spelling FROM vocabulary_spellings WHERE vid = ? AND sid = ?",
+                    (vid, sid)
+                ).fetchone()
+                if row is not None:
+                    spellings_dictionary[(vid, sid)] = row[0]
+        return spellings_dictionary
+
+
+    def add_vocabulary_spellings(self, spellings_dictionary: dict[tuple[int, int], str]) -> None:
+        """
+        Stores spellings looked up from jpdb in a single transaction
+        :param spellings_dictionary: Dictionary of ((vid, sid) : spelling)
+        """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO vocabulary_spellings (vid, sid, spelling) VALUES (?, ?, ?)",
+                ((vid, sid, spelling) for (vid, sid), spelling in spellings_dictionary.items())
+            )
+
+
+    def get_deck_vocabulary(self, deck_id: int) -> list[list] | None:
+        """
+        Gets the last known contents of a deck
+        :param deck_id: id of the deck
+        :return: List of the deck's [vid, sid] pairs, or None if the deck isn't cached
+        """
+        with self._lock:
+            if self._connection.execute("SELECT 1 FROM decks WHERE deck_id = ?", (deck_id,)).fetchone() is None:
+                return None
+            rows = self._connection.execute(
+                "SELECT vid, sid FROM deck_vocabulary WHERE deck_id = ? ORDER BY rowid",
+                (deck_id,)
+            ).fetchall()
+        return [[vid, sid] for vid, sid in rows]
+
+
+    def set_deck_vocabulary(self, deck_id: int, vocabulary_ids_list: list[list]) -> None:
+        """
+        Replaces the cached contents of a deck with its contents fetched from jpdb
+        :param deck_id: id of the deck
+        :param vocabulary_ids_list: the deck's [vid, sid] pairs
+        """
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM deck_vocabulary WHERE deck_id = ?", (deck_id,))
+            self._connection.execute("INSERT OR REPLACE INTO decks (deck_id) VALUES (?)", (deck_id,))
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO deck_vocabulary (deck_id, vid, sid) VALUES (?, ?, ?)",
+                ((deck_id, vid, sid) for vid, sid in vocabulary_ids_list)
+            )
+
+
+    def add_deck_vocabulary(self, deck_id: int, vocabulary_ids_list: list[list]) -> None:
+        """
+        Adds [vid, sid] pairs to the cached contents of a deck, after they were added to the deck on jpdb
+        :param deck_id: id of the deck
+        :param vocabulary_ids_list: the added [vid, sid] pairs
+        """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO deck_vocabulary (deck_id, vid, sid) VALUES (?, ?, ?)",
+                ((deck_id, vid, sid) for vid, sid in vocabulary_ids_list)
+            )
+
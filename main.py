@@ -1,11 +1,31 @@
-from waniwords_utility import read_config_file, write_config_file, generate_frequent_words, generate_frequency_list_file, get_time, print_list
-from wanikani import WaniKaniHandler
+from waniwords_utility import read_config_file, write_config_file, generate_frequent_words, generate_frequency_list_file, get_time, print_list, get_kanji_signature_index
+from wanikani import WaniKaniHandler, FILTER_NAMES, SRS_STAGE_NAMES, KNOWN_KANJI_MIN_SRS_STAGE, KNOWN_VOCABULARY_MIN_SRS_STAGE
 from jpdb import JPDBHandler
+from instrumentation import Instrumentation, write_reports
 from tkinter import *
 from tkinter import ttk
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from cProfile import Profile
+from json import load
+from os import makedirs, path
+from queue import Queue
+from threading import Event  # After the tkinter wildcard import, which has its own Event
+from time import perf_counter
+from typing import Callable
 
+GENERATE_STAGES = [
+    "Downloading WaniKani data",
+    "Loading frequency list",
+    "Filtering words",
+    "Adding words to JPDB deck"
+]
+_PROGRESS_POLL_INTERVAL = 100  # Milliseconds between checks for progress from the background run
+_DEFAULT_WORD_COUNT = 1000
+_DEFAULT_DECK_NAME = "WaniWords"
 
-def main():
+
+def main(metrics_file: str = None, profile_file: str = None):
 
     # print("Generating Frequency List file from database...")
     # generate_frequency_list_file()  # Regenerate file from the database
@@ -14,7 +34,7 @@ def main():
     starting_values = {
         "wanikani_api_key": api_keys["wanikani"],
         "jpdb_api_key": api_keys["jpdb"],
-        "word_count": 1000,
+        "word_count": _DEFAULT_WORD_COUNT,
         "checkbox_values": [
             True, 
             True, 
@@ -25,61 +45,124 @@ def main():
             "Remove vocab with unknown kanji",
             "Remove kana-only vocab"
         ],
-        "deck_name": "WaniWords",
+        "checkbox_filters": [
+            "known_words",
+            "unknown_kanji",
+            "kana_words"
+        ],
+        "kanji_srs_stage": SRS_STAGE_NAMES[KNOWN_KANJI_MIN_SRS_STAGE],
+        "vocabulary_srs_stage": SRS_STAGE_NAMES[KNOWN_VOCABULARY_MIN_SRS_STAGE],
+        "deck_name": _DEFAULT_DECK_NAME,
         "status": "Input both API Keys to begin!"
     }
 
+    generate_executor = ThreadPoolExecutor(max_workers=1)
+    progress_queue = Queue()
+    cancel_event = Event()
+
     def generate_button_function():
         write_config_file({
             "wanikani": wk_key_string.get(),
             "jpdb": jpdb_key_string.get()
         })
 
-        wk_handler = WaniKaniHandler(wk_key_string.get())
-        jpdb_handler = JPDBHandler(jpdb_key_string.get())
-        
+        filter_names = []
+        for i in range(len(checkbox_variable_list)):
+            if checkbox_variable_list[i].get() == True:
+                filter_names.append(starting_values["checkbox_filters"][i])
+
+        # Read every Tk variable here, on the UI thread, before anything changes, so bad input leaves the window usable
         try:
-            wk_handler.download_all_data()  # Download data from wanikani
-        except (KeyError, ConnectionError) as e:
-            status_string.set(e.args[0])
+            word_count = wordcount_int.get()
+        except TclError:
+            word_count = 0
+        if word_count <= 0:
+            status_string.set("Error! The word count must be a positive number.")
             status_label.configure(foreground="#F00")
             return
+        generate_arguments = (
+            wk_key_string.get(),
+            jpdb_key_string.get(),
+            word_count,
+            filter_names,
+            SRS_STAGE_NAMES.index(kanji_srs_stage_string.get()),
+            SRS_STAGE_NAMES.index(vocabulary_srs_stage_string.get()),
+            deck_name_string.get()
+        )
 
-        words_list = generate_frequent_words(wordcount_int.get())
+        # Block double-submits until the run is over
+        generate_button.configure(state="disabled")
+        cancel_button.configure(state="normal")
+        cancel_event.clear()
+        progress_bar.configure(value=0)
+        timings_string.set("")
+        status_string.set("Starting...")
+        status_label.configure(foreground="")
 
-        if checkbox_variable_list[0].get() == True:
-            print("Filtering out known words... ", end="\t")
-            words_list = wk_handler.filter_out_known_words(words_list)
-            print(len(words_list), "words remaining.")
+        # Run the rest in the background
+        generate_executor.submit(generate_worker, *generate_arguments)
+        window.after(_PROGRESS_POLL_INTERVAL, poll_progress)
 
-        if checkbox_variable_list[1].get() == True:
-            print("Filtering out unkown kanji...", end="\t")
-            words_list = wk_handler.filter_out_unknown_kanji(words_list)
-            print(len(words_list), "words remaining.")
 
-        if checkbox_variable_list[2].get() == True:
-            print("Filtering out kana-only words...", end="\t")
-            words_list = wk_handler.filter_out_kana_words(words_list)
-            print(len(words_list), "words remaining.")
-
-        print("Generated list:")
-        print_list(words_list)
-
-        print("Adding words to JPDB deck...")
+    def generate_worker(wk_api_key, jpdb_api_key, word_count, filter_names, kanji_min_srs_stage, vocabulary_min_srs_stage, deck_name):
+        def report_progress(stage, stage_time):
+            progress_queue.put(("progress", stage, stage_time))
+        instrumentation = Instrumentation()
         try:
-            added_words = jpdb_handler.add_vocabulary_to_waniwords_deck(words_list, deck_name_string.get())
-            print("Finished!")
-            status_string.set("Finished! Generated JPDB deck of %d new words to study!" % added_words)
-            status_label.configure(foreground="")
+            added_words = generate_deck(
+                wk_api_key, jpdb_api_key, word_count, filter_names, kanji_min_srs_stage, vocabulary_min_srs_stage, deck_name,
+                report_progress, cancel_event, instrumentation=instrumentation, profile_file=profile_file
+            )
+            progress_queue.put(("finished", added_words))
+        except CancelledError:
+            progress_queue.put(("cancelled",))
         except (KeyError, ConnectionError) as e:
-            status_string.set(e.args[0])
-            status_label.configure(foreground="#F00")
+            progress_queue.put(("error", e.args[0]))
+        except Exception as e:  # Anything else would leave the window waiting forever
+            print("Unexpected error!", repr(e))
+            progress_queue.put(("error", "Error! Unexpected error: %s" % e))
+        finally:
+            if metrics_file is not None:
+                write_reports(metrics_file, {"generate": instrumentation.get_report()})
+
+
+    def cancel_button_function():
+        cancel_event.set()
+        cancel_button.configure(state="disabled")
+        status_string.set("Cancelling...")
+
+
+    def poll_progress():
+        # Runs on the UI thread, so it is the only place that touches the widgets during a run
+        while not progress_queue.empty():
+            event = progress_queue.get()
+            match event[0]:
+                case "progress":
+                    _, stage, stage_time = event
+                    if stage_time is None:
+                        status_string.set(stage + "...")
+                    else:
+                        print("%s took %.2fs" % (stage, stage_time))
+                        progress_bar.configure(value=progress_bar["value"] + 1)
+                        timings_string.set(timings_string.get() + "%s: %.2fs\n" % (stage, stage_time))
+                    continue
+                case "finished":
+                    status_string.set("Finished! Generated JPDB deck of %d new words to study!" % event[1])
+                case "cancelled":
+                    status_string.set("Cancelled!")
+                case "error":
+                    status_string.set(event[1])
+                    status_label.configure(foreground="#F00")
+            generate_button.configure(state="normal")
+            cancel_button.configure(state="disabled")
+            return
+        window.after(_PROGRESS_POLL_INTERVAL, poll_progress)
 
 
     # Window
     window = Tk()
     window.title("WaniWords")
-    window.geometry("500x400")
+    window.geometry("500x590")
 
     # API Key widgets
     ttk.Label(master=window, text="API Keys", font="Calibri 30 bold").pack()
@@ -112,6 +195,15 @@ def main():
         checkbox_value = starting_values["checkbox_values"][i]
         checkbox_variable_list.append(BooleanVar(value=checkbox_value))
         ttk.Checkbutton(master=window, text=checkbox_label, variable=checkbox_variable_list[-1]).pack()
+
+    srs_stage_frame = ttk.Frame(master=window)
+    kanji_srs_stage_string = StringVar(value=starting_values["kanji_srs_stage"])
+    vocabulary_srs_stage_string = StringVar(value=starting_values["vocabulary_srs_stage"])
+    ttk.Label(master=srs_stage_frame, text="Known kanji from", font="Calibri 12").grid(row=0, column=0, sticky="e", padx=5)
+    ttk.Combobox(master=srs_stage_frame, textvariable=kanji_srs_stage_string, values=SRS_STAGE_NAMES[1:], state="readonly", width=14).grid(row=0, column=1)
+    ttk.Label(master=srs_stage_frame, text="Known vocab from", font="Calibri 12").grid(row=1, column=0, sticky="e", padx=5)
+    ttk.Combobox(master=srs_stage_frame, textvariable=vocabulary_srs_stage_string, values=SRS_STAGE_NAMES[1:], state="readonly", width=14).grid(row=1, column=1)
+    srs_stage_frame.pack(pady=5)
     
     deck_name_frame = ttk.Frame(master=window)
     deck_name_string = StringVar(value=starting_values["deck_name"])
@@ -119,15 +211,221 @@ def main():
     ttk.Entry(master=deck_name_frame, textvariable=deck_name_string).pack(side="left")
     deck_name_frame.pack()
     
-    ttk.Button(master=window, text="Generate", command=generate_button_function).pack(pady=15)
+    buttons_frame = ttk.Frame(master=window)
+    generate_button = ttk.Button(master=buttons_frame, text="Generate", command=generate_button_function)
+    generate_button.pack(side="left", padx=5)
+    cancel_button = ttk.Button(master=buttons_frame, text="Cancel", command=cancel_button_function, state="disabled")
+    cancel_button.pack(side="left", padx=5)
+    buttons_frame.pack(pady=15)
 
-    # Status widget
+    # Status widgets
+    progress_bar = ttk.Progressbar(master=window, maximum=len(GENERATE_STAGES), length=300)
+    progress_bar.pack()
     status_string = StringVar(value=starting_values["status"])
     status_label = ttk.Label(master=window, textvariable=status_string)
     status_label.pack()
+    timings_string = StringVar(value="")
+    ttk.Label(master=window, textvariable=timings_string).pack()
 
     # Run
     window.mainloop()
+    cancel_event.set()  # Stop a run that is still going when the window is closed
+    generate_executor.shutdown(wait=False)
+
+
+def generate_deck(wk_api_key: str, jpdb_api_key: str, word_count: int, filter_names: list[str],
+                  kanji_min_srs_stage: int, vocabulary_min_srs_stage: int, deck_name: str,
+                  report_progress: Callable[[str, float], None], cancel_event: Event,
+                  wk_cache_file: str = None, jpdb_cache_file: str = None,
+                  instrumentation: Instrumentation = None, profile_file: str = None) -> int:
+    """
+    Downloads the user's WaniKani data, filters the frequency list with it and adds the result to a jpdb deck
+    :param wk_api_key: the user's WaniKani API Token
+    :param jpdb_api_key: the user's jpdb API Token
+    :param word_count: number of words to take from the frequency list
+    :param filter_names: names of the filters to apply (see wanikani.FILTER_NAMES)
+    :param kanji_min_srs_stage: lowest SRS stage at which a kanji counts as known (see wanikani.SRS_STAGE_NAMES)
+    :param vocabulary_min_srs_stage: lowest SRS stage at which a vocabulary word counts as known
+    :param deck_name: name of the jpdb deck to add the words to
+    :param report_progress: called with (stage, None) when a stage starts or reports its progress, and (stage, seconds) when it ends
+    :param cancel_event: when set, the run stops at the next API call or stage with a CancelledError
+    :param wk_cache_file: path of the WaniKani cache database. Uses the handler's per-token file if None
+    :param jpdb_cache_file: path of the jpdb cache database. Uses the handler's per-token file if None
+    :param instrumentation: records the timings and counters of every stage. Uses a private one if None
+    :param profile_file: if given, the run is profiled with cProfile and the stats are dumped to this file.
+                         Before Python 3.12 this only covers the calling thread, not the download and upload threads.
+                         From 3.12 it covers every thread, but only one profiler can run at a time in a process
+    :return: number of words added to the deck
+    """
+    if instrumentation is None:
+        instrumentation = Instrumentation()
+    if profile_file is not None:
+        profiler = Profile()
+        profiler.enable()
+        try:
+            return generate_deck(
+                wk_api_key, jpdb_api_key, word_count, filter_names, kanji_min_srs_stage, vocabulary_min_srs_stage,
+                deck_name, report_progress, cancel_event, wk_cache_file, jpdb_cache_file, instrumentation
+            )
+        finally:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+
+    wk_handler = WaniKaniHandler(
+        wk_api_key,
+        cancel_event=cancel_event,
+        cache_file=wk_cache_file,
+        kanji_min_srs_stage=kanji_min_srs_stage,
+        vocabulary_min_srs_stage=vocabulary_min_srs_stage,
+        instrumentation=instrumentation
+    )
+    jpdb_handler = JPDBHandler(
+        jpdb_api_key,
+        cancel_event=cancel_event,
+        cache_file=jpdb_cache_file,
+        instrumentation=instrumentation
+    )
+
+    def run_stage(stage, stage_function):
+        if cancel_event.is_set():
+            raise CancelledError("Cancelled!")
+        report_progress(stage, None)
+        stage_start_time = perf_counter()
+        with instrumentation.stage(stage):
+            stage_result = stage_function()
+        report_progress(stage, perf_counter() - stage_start_time)
+        return stage_result
+
+    run_stage(GENERATE_STAGES[0], wk_handler.download_all_data)  # Download data from wanikani
+    words_list = run_stage(GENERATE_STAGES[1], lambda: generate_frequent_words(word_count))
+
+    newly_learned_kanji = wk_handler.get_newly_learned_kanji()
+    if len(newly_learned_kanji) > 0:
+        print("Newly learned kanji:")
+        print_list(newly_learned_kanji)
+        print("Newly unlocked words:")
+        print_list(get_kanji_signature_index().get_newly_unlocked_words(
+            set(wk_handler.get_known_kanji_list()),
+            set(newly_learned_kanji),
+            word_count
+        ))
+
+    words_list, rejection_counts = run_stage(GENERATE_STAGES[2], lambda: wk_handler.filter_words(words_list, filter_names))
+    print(len(words_list), "words remaining.")
+    for filter_name, rejected_count in rejection_counts.items():
+        print("\t%s: %d words removed" % (filter_name, rejected_count))
+
+    print("Generated list:")
+    print_list(words_list)
+
+    def report_upload_progress(uploaded_count, total_count):
+        report_progress("%s (%d/%d words)" % (GENERATE_STAGES[3], uploaded_count, total_count), None)
+
+    added_words = run_stage(GENERATE_STAGES[3], lambda: jpdb_handler.add_vocabulary_to_waniwords_deck(
+        words_list, deck_name, report_progress=report_upload_progress
+    ))
+    print("Finished!")
+    return added_words
+
+
+def batch_main(manifest_file: str, max_workers: int, cache_directory: str, metrics_file: str = None,
+               profile_file: str = None) -> None:
+    """
+    Generates decks for every user in a manifest file without the GUI, several users at a time.
+    The manifest is a JSON object with a non-empty "users" list. Each user needs a unique "name" and "wanikani" and "jpdb" API keys,
+    and can set "word_count", "filters" (see wanikani.FILTER_NAMES), "kanji_srs_stage" and "vocabulary_srs_stage"
+    (lowest SRS stage that counts as known, see wanikani.SRS_STAGE_NAMES) and "deck_name"
+    :param manifest_file: path of the manifest file
+    :param max_workers: maximum number of users processed at once
+    :param cache_directory: directory holding a separate cache folder for each user
+    :param metrics_file: if given, every user's stage timings and counters are written to this JSON file
+    :param profile_file: if given, every user's run is profiled with cProfile and dumped to this file + "." + user name.
+                         Needs max_workers == 1, since only one profiler can run at a time from Python 3.12
+    """
+    if profile_file is not None and max_workers > 1:
+        raise ValueError("Error! Profiling a batch needs a single worker (--workers 1).")
+    with open(manifest_file, "r", encoding='utf-8') as manifest:
+        users = load(manifest)["users"]
+    if len(users) == 0:
+        raise ValueError("Error! The manifest has no users.")
+    user_names = set()
+    for user_index, user in enumerate(users):
+        # Required keys and stage names are checked here, so a mistake stops the batch before any user is processed
+        for required_key in ["name", "wanikani", "jpdb"]:
+            if required_key not in user:
+                raise KeyError("Error! User %d in the manifest has no \"%s\"." % (user_index + 1, required_key))
+        if user["name"] in user_names:  # Names key the cache folders and the reports, so they must be unique
+            raise ValueError("Error! User name \"%s\" appears more than once in the manifest." % user["name"])
+        user_names.add(user["name"])
+        user.setdefault("word_count", _DEFAULT_WORD_COUNT)
+        user.setdefault("filters", FILTER_NAMES)
+        for filter_name in user["filters"]:
+            if filter_name not in FILTER_NAMES:
+                raise KeyError("Error! User %s in the manifest has an unknown filter \"%s\"." % (user["name"], filter_name))
+        user["kanji_min_srs_stage"] = SRS_STAGE_NAMES.index(user.get("kanji_srs_stage", SRS_STAGE_NAMES[KNOWN_KANJI_MIN_SRS_STAGE]))
+        user["vocabulary_min_srs_stage"] = SRS_STAGE_NAMES.index(
+            user.get("vocabulary_srs_stage", SRS_STAGE_NAMES[KNOWN_VOCABULARY_MIN_SRS_STAGE])
+        )
+        user.setdefault("deck_name", _DEFAULT_DECK_NAME)
+
+    # Load the frequency list once up front, so every worker slices the same in-process copy
+    generate_frequent_words(max(user["word_count"] for user in users))
+    cancel_event = Event()
+    reports = {}
+
+    def process_user(user):
+        user_cache_directory = path.join(cache_directory, user["name"])
+        user_start_time = perf_counter()
+        instrumentation = Instrumentation()
+        try:
+            makedirs(user_cache_directory, exist_ok=True)
+            added_words = generate_deck(
+                user["wanikani"],
+                user["jpdb"],
+                user["word_count"],
+                user["filters"],
+                user["kanji_min_srs_stage"],
+                user["vocabulary_min_srs_stage"],
+                user["deck_name"],
+                report_progress=lambda stage, stage_time: None,
+                cancel_event=cancel_event,
+                wk_cache_file=path.join(user_cache_directory, "WaniKani_Cache.sqlite"),
+                jpdb_cache_file=path.join(user_cache_directory, "JPDB_Cache.sqlite"),
+                instrumentation=instrumentation,
+                profile_file=None if profile_file is None else "%s.%s" % (profile_file, user["name"])
+            )
+            status = "Added %d words" % added_words
+        except CancelledError:
+            added_words = 0
+            status = "Cancelled!"
+        except (KeyError, ConnectionError) as e:
+            added_words = 0
+            status = e.args[0]
+        except Exception as e:  # Anything else (e.g. a locked cache) only fails this user, not the whole batch
+            print("Unexpected error for %s!" % user["name"], repr(e))
+            added_words = 0
+            status = "Error! Unexpected error: %s" % e
+        reports[user["name"]] = instrumentation.get_report()
+        return user["name"], perf_counter() - user_start_time, added_words, status
+
+    batch_start_time = perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            results = list(executor.map(process_user, users))
+        except KeyboardInterrupt:
+            cancel_event.set()
+            raise
+    batch_time = perf_counter() - batch_start_time
+
+    print("\nSummary:")
+    for name, user_time, added_words, status in results:
+        print("%-20s %8.2fs\t%s" % (name, user_time, status))
+    print("Processed %d users in %.2fs (%.2f users/s, %d words added)" % (
+        len(results), batch_time, len(results) / batch_time, sum(result[2] for result in results)
+    ))
+    if metrics_file is not None:
+        write_reports(metrics_file, reports)
+        print("Stage metrics written to %s" % metrics_file)
 
 
 def tester_main():
@@ -137,13 +435,21 @@ def tester_main():
 
     wk_handler.download_all_data()
     words_list = generate_frequent_words(2_000)
-    words_list = wk_handler.filter_out_known_words(words_list)
-    words_list = wk_handler.filter_out_kana_words(words_list)
-    words_list = wk_handler.filter_out_unknown_kanji(words_list)
+    words_list, _ = wk_handler.filter_words(words_list, FILTER_NAMES)
     print_list(words_list)
 
     jpdb_handler.add_vocabulary_to_waniwords_deck(words_list)
 
 
 if __name__ == "__main__":
-    main()
+    argument_parser = ArgumentParser(description="Generate jpdb decks of words made of kanji learned on WaniKani.")
+    argument_parser.add_argument("--batch", metavar="MANIFEST", help="process every user in a manifest file without the GUI")
+    argument_parser.add_argument("--workers", type=int, default=4, help="number of users processed at once in batch mode")
+    argument_parser.add_argument("--cache-dir", default="user_caches", help="directory for the per-user caches in batch mode")
+    argument_parser.add_argument("--metrics", metavar="FILE", help="write the timings and counters of every stage to a JSON file")
+    argument_parser.add_argument("--profile", metavar="FILE", help="dump cProfile stats of each run to a file (FILE.<user> in batch mode, which needs --workers 1)")
+    arguments = argument_parser.parse_args()
+    if arguments.batch is not None:
+        batch_main(arguments.batch, arguments.workers, arguments.cache_dir, arguments.metrics, arguments.profile)
+    else:
+        main(arguments.metrics, arguments.profile)
@@ -0,0 +1,111 @@
+from threading import Lock
+from time import monotonic, sleep, time
+from typing import Callable
+
+from requests import Response, Session
+
+_MAX_THROTTLED_RETRIES = 5
+_DEFAULT_THROTTLE_WAIT = 5  # Seconds to wait on a 429 that doesn't say when the limit resets
+
+_rate_limiters = {}
+_rate_limiters_lock = Lock()
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute: int):
+        """
+        Token bucket that paces requests to an API so they stay under its rate limit.
+        The bucket is corrected with the RateLimit-Remaining/RateLimit-Reset headers whenever the API sends them
+        :param requests_per_minute: the API's documented rate limit
+        """
+        self._capacity = requests_per_minute
+        self._refill_rate = requests_per_minute / 60  # Tokens per second
+        self._tokens = float(requests_per_minute)
+        self._last_refill = monotonic()
+        self._blocked_until = 0.0  # monotonic() time before which no request may be sent
+        self._lock = Lock()
+
+
+    def _acquire(self) -> None:
+        """
+        Blocks until a request may be sent, then takes a token from the bucket
+        """
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._last_refill) * self._refill_rate)
+                self._last_refill = now
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_time = max(self._blocked_until - now, (1 - self._tokens) / self._refill_rate)
+            sleep(wait_time)
+
+
+    def _update_from_headers(self, response: Response) -> None:
+        """
+        Syncs the bucket with the API's own count of the remaining requests, if the response reports it
+        :param response: the API's response
+        """
+        remaining = response.headers.get("RateLimit-Remaining")
+        if remaining is None:
+            return
+        with self._lock:
+            self._tokens = min(self._tokens, float(remaining))
+            if self._tokens < 1:
+                self._block_until_reset(response)
+
+
+    def _block_until_reset(self, response: Response) -> None:
+        """
+        Stops all requests until the API's rate limit window resets. Must be called with the lock held
+        :param response: the API's response, which may say when the limit resets
+        """
+        if "RateLimit-Reset" in response.headers:  # Epoch time of the reset
+            wait_time = float(response.headers["RateLimit-Reset"]) - time()
+        elif "Retry-After" in response.headers:  # Seconds until the reset
+            wait_time = float(response.headers["Retry-After"])
+        else:
+            wait_time = _DEFAULT_THROTTLE_WAIT
+        self._blocked_until = max(self._blocked_until, monotonic() + max(wait_time, 0) + 1)
+
+
+    def request(self, session: Session, method: str, url: str, on_response: Callable[[Response], None] = None,
+                **kwargs) -> Response:
+        """
+        Sends a request through the rate limiter, retrying it if the API still throttles it
+        :param session: the Session to send the request with
+        :param method: HTTP method of the request
+        :param url: URL of the request
+        :param on_response: called with every response received, throttled ones included
+        :param kwargs: any other arguments for Session.request
+        :return: the API's response. Still a 429 response if every retry was throttled
+        """
+        for _ in range(_MAX_THROTTLED_RETRIES):
+            self._acquire()
+            response = session.request(method=method, url=url, **kwargs)
+            if on_response is not None:
+                on_response(response)
+            if response.status_code != 429:
+                self._update_from_headers(response)
+                return response
+            print("Rate limited! Waiting for the limit to reset...")
+            with self._lock:
+                self._tokens = 0
+                self._block_until_reset(response)
+        return response
+
+
+def get_rate_limiter(api_name: str, api_token: str, requests_per_minute: int) -> RateLimiter:
+    """
+    Returns the RateLimiter shared by every handler of the given API and token, creating it on first use.
+    Rate limits are counted per token, so handlers for different users don't slow each other down
+    :param api_name: name of the API, e.g. "wanikani"
+    :param api_token: the API token the requests are sent with
+    :param requests_per_minute: the API's rate limit. Only used when the RateLimiter is created
+    :return: The shared RateLimiter
+    """
+    with _rate_limiters_lock:
+        if (api_name, api_token) not in _rate_limiters:
+            _rate_limiters[(api_name, api_token)] = RateLimiter(requests_per_minute)
+        return _rate_limiters[(api_name, api_token)]
@@ -1,217 +1,466 @@
-from json import load, dump, decoder
-from requests import request
-
-from waniwords_utility import get_time, KANA_LIST
-
-_WANIKANI_CACHE_FILE = "WaniKani_Cache.json"
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor, as_completed, CancelledError
+from datetime import datetime, timedelta, timezone
+from threading import Event, Lock
+from typing import Callable, Iterable, Iterator
+from urllib.parse import urlencode
+from instrumentation import Instrumentation
+from rate_limiter import get_rate_limiter
+from wanikani_cache import WaniKaniCache
+from waniwords_utility import get_time, parse_time, get_token_hash, create_session, get_kanji_signature_index, KANA_SET
+
+_WANIKANI_API_URL = "https://api.wanikani.com/v2/"
+_WANIKANI_RATE_LIMIT = 60  # Requests per minute
+_WANIKANI_CACHE_FILE = "WaniKani_Cache_%s.sqlite"  # Namespaced by the hash of the API token
+_WANIKANI_CATALOG_FILE = "WaniKani_Subjects.sqlite"  # Subject catalog, shared by every user
+_CATALOG_MAX_AGE = timedelta(days=7)  # The subject catalog rarely changes, so it is only refreshed this often
+# Names of the WaniKani SRS stages, indexed by stage. Stage 0 is an unlocked subject whose lesson isn't done yet
+SRS_STAGE_NAMES = [
+    "Initiate",
+    "Apprentice I", "Apprentice II", "Apprentice III", "Apprentice IV",
+    "Guru I", "Guru II",
+    "Master",
+    "Enlightened",
+    "Burned"
+]
+KNOWN_KANJI_MIN_SRS_STAGE = 5       # Guru I
+KNOWN_VOCABULARY_MIN_SRS_STAGE = 1  # Apprentice I
+# Filters understood by WaniKaniHandler.filter_words, ordered cheapest first
+FILTER_NAMES = ["known_words", "kana_words", "unknown_kanji"]
 
 class WaniKaniHandler:
-    def __init__(self, api_token):
+    def __init__(self, api_token, pool_size: int = 4, timeout: float = 30, max_retries: int = 3, cancel_event: Event = None,
+                 cache_file: str = None, catalog_file: str = None, kanji_min_srs_stage: int = KNOWN_KANJI_MIN_SRS_STAGE,
+                 vocabulary_min_srs_stage: int = KNOWN_VOCABULARY_MIN_SRS_STAGE, instrumentation: Instrumentation = None):
         """
         Creates a WaniKaniHandler that interfaces with the WaniKani API and takes care of the user's data.
         Takes data from the cache file.
         :param api_token: the user's WaniKani API Token. Only needs read permissions
+        :param pool_size: number of pooled keep-alive connections to the API
+        :param timeout: seconds to wait for the API before a request fails
+        :param max_retries: number of retries with backoff on 5xx responses
+        :param cancel_event: when set, downloads stop before their next request with a CancelledError
+        :param cache_file: path of the user's cache database. Uses a file named after the token's hash if None
+        :param catalog_file: path of the subject catalog database shared by every user. Uses the default file if None
+        :param kanji_min_srs_stage: lowest SRS stage at which a kanji counts as known (see SRS_STAGE_NAMES)
+        :param vocabulary_min_srs_stage: lowest SRS stage at which a vocabulary word counts as known
+        :param instrumentation: records the timings and counters of each crawl and filter. Uses a private one if None
         """
         self._api_token = api_token
+        self._timeout = timeout
+        self._cancel_event = cancel_event
+        self._session = create_session(
+            pool_size=pool_size,
+            max_retries=max_retries,
+            headers={
+                "Authorization": "Bearer " + api_token
+            }
+        )
+        self._rate_limiter = get_rate_limiter("wanikani", api_token, _WANIKANI_RATE_LIMIT)
+        self._instrumentation = Instrumentation() if instrumentation is None else instrumentation
+        if cache_file is None:
+            cache_file = _WANIKANI_CACHE_FILE % get_token_hash(api_token)
+        if catalog_file is None:
+            catalog_file = _WANIKANI_CATALOG_FILE
+        self._cache = WaniKaniCache(cache_file, catalog_file)
+        self._pending_changes = {}  # Data downloaded by the current sync, written to the cache once it completes
+        self._pending_changes_lock = Lock()
+        self._min_srs_stages = {"kanji": kanji_min_srs_stage, "vocabulary": vocabulary_min_srs_stage}
+        self._stage_buckets = None  # (subject_type : list of the frozensets of characters at each SRS stage)
+        self._known_vocabulary_set = None
+        self._known_characters_set = None
+        self._known_list_words_cache = (None, frozenset(), frozenset())  # (KanjiSignatureIndex, known kanji, known words)
+        self._newly_learned_kanji = []
+
+
+    def _get_page(self, url: str, parameters: dict[str, str] | None, headers: dict[str, str] | None,
+                  stage_name: str) -> tuple[dict | None, dict]:
+        """
+        Requests a single page of a collection from the WaniKani API
+        :param url: URL of the page
+        :param parameters: Parameters and Filters of the request. None for the following pages, whose URL already has them
+        :param headers: conditional request headers. None for the following pages
+        :param stage_name: instrumentation stage the request is counted towards
+        :return: Tuple of (the page's JSON object, or None if the collection is unchanged (304), the response's headers)
+        """
+        if self._cancel_event is not None and self._cancel_event.is_set():
+            raise CancelledError("Cancelled!")
         try:
-            cache_file = open(_WANIKANI_CACHE_FILE, "r", encoding='utf-8')
-            self._data_dictionary = load(cache_file)
-        except FileNotFoundError:
-            print("Creating new cache file...")
-            cache_file = open(_WANIKANI_CACHE_FILE, "x", encoding='utf-8')
-            self._data_dictionary = {}
-        except decoder.JSONDecodeError:
-            print("Error decoding cache file. Ignoring cache contents.")
-            self._data_dictionary = {}
-        finally:
-            cache_file.close()
-
-
-    def _call_api(self, endpoint: str, parameters: dict[str, str]) -> list[dict]:
-        """
-        Wrapper for calling the WaniKani API. Packages the received data into a list
+            response = self._rate_limiter.request(
+                session=self._session,
+                method="GET",
+                url=url,
+                on_response=lambda response: self._instrumentation.record_response(stage_name, response),
+                params=parameters,
+                headers=headers,
+                timeout=self._timeout
+            )
+            if response.status_code == 304:  # Collection unchanged since the last sync
+                return None, response.headers
+            return response.json(), response.headers
+        except:  # I know, I know... I am sorry
+            print("WaniKani Request error!")
+            raise ConnectionError("Error! WaniKani API Connection failed. Check your internet connection?")
+
+
+    def _iter_api(self, endpoint: str, parameters: dict[str, str]) -> Iterator[dict]:
+        """
+        Wrapper for calling the WaniKani API. Yields the received records page by page, while the next page
+        is already being downloaded in the background, so only about two pages are ever held in memory.
+        Each collection (endpoint + parameters) keeps its own updated_after timestamp and ETag/Last-Modified validators,
+        so a collection that hasn't changed since the last sync costs a single 304 response.
+        The collection's sync state is only updated once every page has been consumed
         :param endpoint: URL endpoint for the API request
         :param parameters: Parameters and Filters for the initial API request
-        :return: List of JSON objects received from the request
-        """
-        data_array = []
-        next_page = "https://api.wanikani.com/v2/" + endpoint
-        if "timestamp" in self._data_dictionary:
-            next_page += "?updated_after=" + self._data_dictionary["timestamp"]
-
-        while next_page is not None:
-            try:
-                response_json = request(
-                    method="GET",
-                    url=next_page,
-                    headers={
-                        "Authorization": "Bearer " + self._api_token
-                    },
-                    params=parameters
-                ).json()
-            except:  # I know, I know... I am sorry
-                print("WaniKani Request error!")
-                raise ConnectionError("Error! WaniKani API Connection failed. Check your internet connection?")
-            try:
-                data_array += response_json["data"]
-                parameters = None
-                next_page = response_json["pages"]["next_url"]
-            except KeyError:
-                response_code = response_json["code"]
-                match response_code:
-                    case 401:
-                        print("WaniKani API Error! WaniKani API Key is invalid.")
-                        raise KeyError("Error! WaniKani API Key is invalid.")
-                    case _:
-                        print("WaniKani API Error! Response Code: %d." % response_code)
-                        raise KeyError("WaniKani API Error! Response Code: %d." % response_code)
-
-        return data_array
-
-
-    def download_all_data(self) -> None:
-        """
-        Downloads the subjects and assignments for both vocabulary and kanji.
-        Writes the downloaded data to the cache file
+        :return: Iterator over the JSON objects received from the request
         """
-        print("Downloading User Kanji...", end="\t\t")
-        self._download_user_known_kanji()
-        print("Done")
-
-        print("Downloading User Vocabulary...", end="\t\t")
-        self._download_user_known_vocabulary()
-        print("Done")
-
-        print("Downloading WaniKani Kanji...", end="\t\t")
-        self._download_wanikani_kanji()
-        print("Done")
+        collection_key = endpoint + "?" + urlencode(sorted(parameters.items()))
+        collection = self._cache.get_collection(collection_key)
+
+        parameters = dict(parameters)
+        headers = {}
+        if "updated_after" in collection:
+            parameters["updated_after"] = collection["updated_after"]
+            # Validators only apply to the exact request they were received for
+            if collection.get("validated_updated_after") == collection["updated_after"]:
+                if "etag" in collection:
+                    headers["If-None-Match"] = collection["etag"]
+                if "last_modified" in collection:
+                    headers["If-Modified-Since"] = collection["last_modified"]
+
+        crawl_start_time = get_time()
+        first_page_headers = None
+        received_data = False
+        stage_name = "wanikani " + collection_key
+        with self._instrumentation.stage(stage_name) as stage_counters, ThreadPoolExecutor(max_workers=1) as prefetcher:
+            stage_counters["items_out"] = 0
+            next_page = prefetcher.submit(self._get_page, _WANIKANI_API_URL + endpoint, parameters, headers, stage_name)
+            while next_page is not None:
+                response_json, response_headers = next_page.result()
+                if response_json is None:
+                    self._add_pending_changes(table="collections", key=collection_key, new_data=collection)
+                    return
+                try:
+                    page_data = response_json["data"]
+                    next_page_url = response_json["pages"]["next_url"]
+                except KeyError:
+                    response_code = response_json["code"]
+                    match response_code:
+                        case 401:
+                            print("WaniKani API Error! WaniKani API Key is invalid.")
+                            raise KeyError("Error! WaniKani API Key is invalid.")
+                        case 429:
+                            print("WaniKani API Error! Rate limit exceeded.")
+                            raise KeyError("Error! WaniKani API rate limit exceeded. Try again in a minute.")
+                        case _:
+                            print("WaniKani API Error! Response Code: %d." % response_code)
+                            raise KeyError("WaniKani API Error! Response Code: %d." % response_code)
+                if first_page_headers is None:
+                    first_page_headers = response_headers
+                # Start on the next page before handing this one to the caller
+                next_page = None if next_page_url is None else prefetcher.submit(
+                    self._get_page, next_page_url, None, None, stage_name
+                )
+                received_data = received_data or len(page_data) > 0
+                stage_counters["items_out"] += len(page_data)
+                yield from page_data
+
+        self._update_collection_validators(collection_key, collection, first_page_headers, crawl_start_time, received_data)
+
+
+    def _update_collection_validators(self, collection_key: str, collection: dict, response_headers,
+                                      crawl_start_time: str, received_data: bool) -> None:
+        """
+        Stores the updated_after timestamp and validators to use for the collection's next sync.
+        The timestamp only moves forward when new data arrived, so an unchanged collection keeps sending
+        the same request and its validators stay valid
+        :param collection_key: key of the collection (endpoint + parameters)
+        :param collection: the collection's previous timestamp and validators
+        :param response_headers: headers of the first page of the completed crawl
+        :param crawl_start_time: time the crawl started, used as the next updated_after
+        :param received_data: whether the crawl returned any records
+        """
+        new_collection = {"validated_updated_after": collection.get("updated_after")}
+        if received_data or "updated_after" not in collection:
+            new_collection["updated_after"] = crawl_start_time
+        else:
+            new_collection["updated_after"] = collection["updated_after"]
+        if "ETag" in response_headers:
+            new_collection["etag"] = response_headers["ETag"]
+        if "Last-Modified" in response_headers:
+            new_collection["last_modified"] = response_headers["Last-Modified"]
+        self._add_pending_changes(table="collections", key=collection_key, new_data=new_collection)
 
-        print("Downloading WaniKani Vocabulary...", end="\t")
-        self._download_wanikani_vocabulary()
-        print("Done")
 
+    def download_all_data(self, refresh_catalog: bool = False) -> None:
+        """
+        Downloads the assignments for both vocabulary and kanji, and the subjects if the shared catalog is due a refresh.
+        The collections are independent, so they are downloaded concurrently.
+        Writes the downloaded data to the cache file
+        :param refresh_catalog: refresh the subject catalog even if it isn't due yet
+        """
+        self._pending_changes = {
+            "subjects": {},
+            "assignments": {},
+            "collections": {}
+        }
+        downloads = {
+            "User Kanji": self._download_user_kanji,
+            "User Vocabulary": self._download_user_vocabulary
+        }
+        catalog_downloads = {
+            "WaniKani Kanji": self._download_wanikani_kanji,
+            "WaniKani Vocabulary": self._download_wanikani_vocabulary
+        }
+        refresh_catalog = refresh_catalog or self._is_catalog_stale()
+        if refresh_catalog:
+            downloads |= catalog_downloads
+        previous_known_kanji = self._get_known_characters(subject_type="kanji")
+        print("Downloading WaniKani data...")
+        self._run_downloads(downloads)
         self._write_cache()
+        missing_subject_count = self._load_stage_buckets()
+
+        # A subject added to WaniKani since the catalog's last refresh would never count as known, so catch up on it now.
+        # The subject collections keep their updated_after, so this only downloads what changed
+        if missing_subject_count > 0 and not refresh_catalog:
+            print("%d assigned subjects are missing from the subject catalog. Updating the catalog..." % missing_subject_count)
+            self._pending_changes = {
+                "subjects": {},
+                "assignments": {},
+                "collections": {}
+            }
+            self._run_downloads(catalog_downloads)
+            self._write_cache()
+            missing_subject_count = self._load_stage_buckets()
+        if missing_subject_count > 0:
+            print("Warning! %d assigned subjects are not in the WaniKani subject catalog and are ignored." % missing_subject_count)
+        self._build_known_character_index()
+        if len(previous_known_kanji) > 0:  # On a first sync every kanji would count as newly learned
+            self._newly_learned_kanji = [kanji for kanji in self.get_known_kanji_list() if kanji not in previous_known_kanji]
     
 
-    def _update_data_dictionary(self, key, new_data):
-        if key in self._data_dictionary:
-            self._data_dictionary[key] |= new_data
-        else:
-            self._data_dictionary[key] = new_data
+    def _run_downloads(self, downloads: dict[str, Callable[[], None]]) -> None:
+        """
+        Runs downloads concurrently, as the collections are independent
+        :param downloads: (name : download method) of the downloads to run
+        """
+        with ThreadPoolExecutor(max_workers=len(downloads)) as executor:
+            futures = {executor.submit(download): name for name, download in downloads.items()}
+            for future in as_completed(futures):
+                future.result()  # Re-raises any KeyError or ConnectionError from the download
+                print("Downloaded %s" % futures[future])
+
 
+    def _is_catalog_stale(self) -> bool:
+        """
+        Checks if the shared subject catalog is missing or older than _CATALOG_MAX_AGE
+        :return: True if the catalog should be refreshed
+        """
+        catalog_refresh_time = self._cache.get_catalog_refresh_time()
+        if catalog_refresh_time is None:
+            return True
+        return datetime.now(timezone.utc) - parse_time(catalog_refresh_time) > _CATALOG_MAX_AGE
+
+
+    def _add_pending_changes(self, table: str, key: str, new_data: dict) -> None:
+        """
+        Adds downloaded data to the changes that are written to the cache at the end of the sync
+        :param table: cache table the data belongs to ("subjects", "assignments" or "collections")
+        :param key: subject type for subjects and assignments, collection key for collections
+        :param new_data: the downloaded data
+        """
+        with self._pending_changes_lock:
+            if key in self._pending_changes[table]:
+                self._pending_changes[table][key] |= new_data
+            else:
+                self._pending_changes[table][key] = new_data
 
 
     def _download_wanikani_kanji(self) -> None:
         """
         Downloads all the WaniKani kanji subjects.
-        Stored in a dictionary as a (subject_id : kanji_string) pair
+        Stored in the subjects table as a (subject_id : kanji_string) pair
         """
-        kanji_subjects_list = self._call_api(
+        kanji_subjects = self._iter_api(
             endpoint="subjects",
             parameters={
                 "types": "kanji"
             }
         )
+        # Keep only the characters of each subject, and drop the rest of the record as it streams past
         id_to_kanji_dictionary = {}
-        for kanji in kanji_subjects_list:
-            id = str(kanji["id"])
-            id_to_kanji_dictionary[id] = kanji["data"]["characters"]
+        for kanji in kanji_subjects:
+            id_to_kanji_dictionary[kanji["id"]] = kanji["data"]["characters"]
 
-        self._update_data_dictionary(key="all_kanji_subjects", new_data=id_to_kanji_dictionary)
+        self._add_pending_changes(table="subjects", key="kanji", new_data=id_to_kanji_dictionary)
 
 
     def _download_wanikani_vocabulary(self) -> None:
         """
         Downloads all the WaniKani vocabulary subjects
-        Stored in a dictionary as a (subject_id : vocabulary_string) pair
+        Stored in the subjects table as a (subject_id : vocabulary_string) pair
         """
-        vocabulary_subjects_list = self._call_api(
+        vocabulary_subjects = self._iter_api(
             endpoint="subjects",
             parameters={
                 "types": "vocabulary,kana_vocabulary"
             }
         )
+        # Keep only the characters of each subject, and drop the rest of the record as it streams past
         id_to_vocabulary_dictionary = {}
-        for vocabulary in vocabulary_subjects_list:
-            id = str(vocabulary["id"])
-            id_to_vocabulary_dictionary[id] = vocabulary["data"]["characters"]
+        for vocabulary in vocabulary_subjects:
+            id_to_vocabulary_dictionary[vocabulary["id"]] = vocabulary["data"]["characters"]
 
-        self._update_data_dictionary(key="all_vocabulary_subjects", new_data=id_to_vocabulary_dictionary)
+        self._add_pending_changes(table="subjects", key="vocabulary", new_data=id_to_vocabulary_dictionary)
 
 
-    def _download_user_known_kanji(self) -> None:
+    def _download_user_kanji(self) -> None:
         """
-        Downloads user's kanji assignments that are Guru level or higher
-        Stored in a dictionary as a (subject_id : srs_stage) pair
+        Downloads user's kanji assignments at every SRS stage, so any threshold can be applied without downloading again.
+        Stored in the assignments table as a (subject_id : srs_stage) pair
         """
-        kanji_assignments_list = self._call_api(
+        kanji_assignments = self._iter_api(
             endpoint="assignments",
             parameters={
-                "subject_types": "kanji",
-                "srs_stages": "5,6,7,8,9"
+                "subject_types": "kanji"
             }
         )
         id_to_srs_dictionary = {}
-        for kanji in kanji_assignments_list:
-            id = str(kanji["data"]["subject_id"])
-            id_to_srs_dictionary[id] = kanji["data"]["srs_stage"]
-        self._update_data_dictionary(key="user_kanji_assignments", new_data=id_to_srs_dictionary)
+        for kanji in kanji_assignments:
+            id_to_srs_dictionary[kanji["data"]["subject_id"]] = kanji["data"]["srs_stage"]
+        self._add_pending_changes(table="assignments", key="kanji", new_data=id_to_srs_dictionary)
 
 
-    def _download_user_known_vocabulary(self) -> None:
+    def _download_user_vocabulary(self) -> None:
         """
-        Downloads user's vocabulary assignments that are Apprentice level or higher
-        Stored in a dictionary as a (subject_id : srs_stage) pair
+        Downloads user's vocabulary assignments at every SRS stage
+        Stored in the assignments table as a (subject_id : srs_stage) pair
         """
-        vocabulary_assignments_list = self._call_api(
+        vocabulary_assignments = self._iter_api(
             endpoint="assignments",
             parameters={
-                "subject_types": "vocabulary,kana_vocabulary",
-                "srs_stages": "1,2,3,4,5,6,7,8,9"
+                "subject_types": "vocabulary,kana_vocabulary"
             }
         )
         id_to_srs_dictionary = {}
-        for vocabulary in vocabulary_assignments_list:
-            id = str(vocabulary["data"]["subject_id"])
-            id_to_srs_dictionary[id] = vocabulary["data"]["srs_stage"]
+        for vocabulary in vocabulary_assignments:
+            id_to_srs_dictionary[vocabulary["data"]["subject_id"]] = vocabulary["data"]["srs_stage"]
         
-        self._update_data_dictionary(key="user_vocabulary_assignments", new_data=id_to_srs_dictionary)
+        self._add_pending_changes(table="assignments", key="vocabulary", new_data=id_to_srs_dictionary)
 
 
     def _write_cache(self) -> None:
         """
-        Writes the currently held data to the cache file, timestamped
+        Writes the data downloaded by this sync to the cache file in one transaction, timestamped
         """
-        self._data_dictionary["timestamp"] = get_time()
-        with open(_WANIKANI_CACHE_FILE, "w", encoding='utf-8') as cache_file:
-            dump(
-                self._data_dictionary,
-                cache_file,
-                indent=3,
-                ensure_ascii=False
-            )
+        self._cache.write_changes(
+            subjects=self._pending_changes["subjects"],
+            assignments=self._pending_changes["assignments"],
+            collections=self._pending_changes["collections"],
+            timestamp=get_time()
+        )
+        self._pending_changes = {}
 
 
-    def get_known_kanji_list(self) -> list[str]:
+    def _load_stage_buckets(self) -> int:
+        """
+        Loads the subject catalog and the user's assignments from the cache, and sorts the characters of every assigned
+        subject into one frozenset per SRS stage. The known sets for any threshold are then unions of these buckets.
+        WaniKani subject ids are small and dense, so the catalog is indexed with a list of characters by subject id.
+        Reloaded after every download, so the known sets never have to go back to the cache file
+        :return: Number of assigned subjects that are missing from the subject catalog
+        """
+        self._stage_buckets = {}
+        missing_subject_count = 0
+        for subject_type in ["kanji", "vocabulary"]:
+            subject_ids, characters = self._cache.get_subjects(subject_type)
+            characters_by_id = [None] * (subject_ids[-1] + 1 if len(subject_ids) > 0 else 0)
+            for subject_id, subject_characters in zip(subject_ids, characters):
+                characters_by_id[subject_id] = subject_characters
+
+            assigned_subject_ids, srs_stages = self._cache.get_assignments(subject_type)
+            stage_buckets = [[] for _ in SRS_STAGE_NAMES]
+            for subject_id, srs_stage in zip(assigned_subject_ids, srs_stages):
+                if subject_id < len(characters_by_id) and characters_by_id[subject_id] is not None:
+                    stage_buckets[srs_stage].append(characters_by_id[subject_id])
+                else:
+                    # Subjects without characters are in the catalog too, so only count ids the catalog doesn't have
+                    subject_index = bisect_left(subject_ids, subject_id)
+                    if subject_index == len(subject_ids) or subject_ids[subject_index] != subject_id:
+                        missing_subject_count += 1
+            self._stage_buckets[subject_type] = [frozenset(bucket) for bucket in stage_buckets]
+        return missing_subject_count
+
+
+    def _get_known_characters(self, subject_type: str, min_srs_stage: int = None) -> frozenset[str]:
+        """
+        Gets the characters of the user's subjects at or above an SRS stage, as the union of the stage buckets
+        :param subject_type: "kanji" or "vocabulary"
+        :param min_srs_stage: lowest SRS stage that counts as known. Uses the handler's threshold for the type if None
+        :return: frozenset containing unicode strings of the known subjects
+        """
+        if self._stage_buckets is None:
+            self._load_stage_buckets()
+        if min_srs_stage is None:
+            min_srs_stage = self._min_srs_stages[subject_type]
+        return frozenset().union(*self._stage_buckets[subject_type][min_srs_stage:])
+
+
+    def get_known_kanji_list(self, min_srs_stage: int = None) -> list[str]:
         """
         Cross-references the user and wanikani data to produce a list of known kanji
+        :param min_srs_stage: lowest SRS stage that counts as known. Uses the handler's threshold if None
         :return: List containing unicode strings of kanji
         """
-        known_kanji_list = []
-        for lesson_id in self._data_dictionary["user_kanji_assignments"]:
-            known_kanji_list.append(self._data_dictionary["all_kanji_subjects"][lesson_id])
-        return known_kanji_list
+        return list(self._get_known_characters(subject_type="kanji", min_srs_stage=min_srs_stage))
 
 
-    def get_known_vocabulary_list(self) -> list[str]:
+    def get_known_vocabulary_list(self, min_srs_stage: int = None) -> list[str]:
         """
         Cross-references the user and wanikani data to produce a list of known vocabulary words
+        :param min_srs_stage: lowest SRS stage that counts as known. Uses the handler's threshold if None
         :return: List containing unicode strings of vocabulary words
         """
-        known_vocabulary_list = []
-        for lesson_id in self._data_dictionary["user_vocabulary_assignments"]:
-            known_vocabulary_list.append(self._data_dictionary["all_vocabulary_subjects"][lesson_id])
-        return known_vocabulary_list
+        return list(self._get_known_characters(subject_type="vocabulary", min_srs_stage=min_srs_stage))
+
+
+    def set_srs_thresholds(self, kanji_min_srs_stage: int, vocabulary_min_srs_stage: int) -> None:
+        """
+        Changes the SRS stages at which kanji and vocabulary count as known.
+        Only rebuilds the filters' known sets from the stage buckets, without downloading anything
+        :param kanji_min_srs_stage: lowest SRS stage at which a kanji counts as known (see SRS_STAGE_NAMES)
+        :param vocabulary_min_srs_stage: lowest SRS stage at which a vocabulary word counts as known
+        """
+        self._min_srs_stages = {"kanji": kanji_min_srs_stage, "vocabulary": vocabulary_min_srs_stage}
+        self._build_known_character_index()
+
+
+    def get_newly_learned_kanji(self) -> list[str]:
+        """
+        Gets the kanji that became known during the last download_all_data
+        :return: List containing unicode strings of kanji
+        """
+        return self._newly_learned_kanji
+
+
+    def _build_known_character_index(self) -> None:
+        """
+        Builds the sets of known vocabulary and known characters (kana + known kanji) used by the filters.
+        Rebuilt after every download so the filters never have to cross-reference the raw data themselves
+        """
+        self._known_vocabulary_set = self._get_known_characters(subject_type="vocabulary")
+        self._known_characters_set = KANA_SET | self._get_known_characters(subject_type="kanji")
+
+
+    def _get_known_character_index(self) -> tuple[frozenset, frozenset]:
+        """
+        Returns the known vocabulary and known character sets, building them from the cached data if needed
+        :return: Tuple of (known vocabulary set, known characters set)
+        """
+        if self._known_vocabulary_set is None or self._known_characters_set is None:
+            self._build_known_character_index()
+        return self._known_vocabulary_set, self._known_characters_set
 
 
     def filter_out_known_words(self, list_of_words: list[str]) -> list[str]:
@@ -220,12 +469,8 @@ class WaniKaniHandler:
         :param list_of_words: list of words to be filtered
         :return: list of words that passed the filter
         """
-        known_vocabulary = self.get_known_vocabulary_list()
-        new_list_of_words = []
-        for word in list_of_words:
-            if word not in known_vocabulary:
-                new_list_of_words.append(word)
-        return new_list_of_words
+        known_vocabulary, _ = self._get_known_character_index()
+        return [word for word in list_of_words if word not in known_vocabulary]
 
 
     def filter_out_unknown_kanji(self, list_of_words: list[str]) -> list[str]:
@@ -234,16 +479,8 @@ class WaniKaniHandler:
         :param list_of_words: list of words to be filtered
         :return: list of words that passed the filter
         """
-        new_list_of_words = []
-        known_characters = KANA_LIST + self.get_known_kanji_list()
-
-        for word in list_of_words:
-            for character in word:
-                if character not in known_characters:
-                    break
-            else:
-                new_list_of_words.append(word)    
-        return new_list_of_words
+        _, known_characters = self._get_known_character_index()
+        return [word for word in list_of_words if known_characters.issuperset(word)]
     
 
     def filter_out_kana_words(self, list_of_words: list[str]) -> list[str]:
@@ -252,14 +489,81 @@ class WaniKaniHandler:
         :param list_of_words: list of words to be filtered
         :return: list of words that passed the filter
         """
-        new_list_of_words = []
-        known_characters = KANA_LIST
+        return [word for word in list_of_words if not KANA_SET.issuperset(word)]
 
-        for word in list_of_words:
-            for character in word:
-                if character not in known_characters:
-                    break
-            else:
-                continue  # Continue to the outer loop to skip appending
-            new_list_of_words.append(word)                
-        return new_list_of_words
\ No newline at end of file
+
+    def _get_filter_predicates(self) -> dict[str, Callable[[str], bool]]:
+        """
+        Builds the predicates behind each named filter. A predicate returns True if the word should be kept
+        :return: Dictionary of (filter_name : predicate) pairs, ordered cheapest first
+        """
+        known_vocabulary, known_characters = self._get_known_character_index()
+        word_signatures, known_list_words = self._get_known_list_words(known_characters - KANA_SET)
+        return {
+            "known_words": lambda word: word not in known_vocabulary,  # Single hash lookup
+            "kana_words": lambda word: not KANA_SET.issuperset(word),  # Usually stops at the first kanji
+            # Words in the frequency list are looked up, and only the others have to scan every character
+            "unknown_kanji": lambda word: word in known_list_words or (
+                word not in word_signatures and known_characters.issuperset(word)
+            )
+        }
+
+
+    def _get_known_list_words(self, known_kanji: frozenset[str]) -> tuple[dict[str, frozenset[str]], frozenset[str]]:
+        """
+        Finds the words of the frequency list made only of known kanji, with the list's KanjiSignatureIndex.
+        When kanji were only added since the last call, just the words using the new kanji are checked
+        :param known_kanji: Set of all known kanji
+        :return: Tuple of (kanji signature of every word in the list, set of the words made only of known kanji).
+                 Both are empty if there is no frequency list
+        """
+        try:
+            kanji_signature_index = get_kanji_signature_index()
+        except FileNotFoundError:  # No frequency list, so the filter scans every word
+            return {}, frozenset()
+        cached_index, cached_kanji, known_list_words = self._known_list_words_cache
+        if cached_index is kanji_signature_index and cached_kanji <= known_kanji:
+            new_kanji = known_kanji - cached_kanji
+            if len(new_kanji) > 0:
+                known_list_words = known_list_words.union(kanji_signature_index.get_newly_unlocked_words(known_kanji, new_kanji))
+        else:  # First call, a new list, or kanji were lost (e.g. a higher SRS threshold)
+            known_list_words = kanji_signature_index.get_known_words(known_kanji)
+        self._known_list_words_cache = (kanji_signature_index, known_kanji, known_list_words)
+        return kanji_signature_index.get_word_signatures(), known_list_words
+
+
+    def filter_words(self, words: Iterable[str], filter_names: list[str],
+                     extra_filters: dict[str, Callable[[str], bool]] = None) -> tuple[list[str], dict[str, int]]:
+        """
+        Runs the chosen filters over the words in a single pass. Each word stops at the first filter that rejects it
+        :param words: iterable of words to be filtered
+        :param filter_names: names of the built-in filters to apply (see FILTER_NAMES). Always run cheapest first
+        :param extra_filters: additional (filter_name : predicate) pairs, run after the built-in filters
+        :return: Tuple of (list of words that passed every filter, dictionary of (filter_name : rejected word count))
+        """
+        predicates = self._get_filter_predicates()
+        stages = [(name, predicates[name]) for name in FILTER_NAMES if name in filter_names]
+        if extra_filters is not None:
+            stages += list(extra_filters.items())
+
+        rejection_counts = {name: 0 for name, _ in stages}
+        new_list_of_words = []
+        word_count = 0
+        with self._instrumentation.stage("filter_words") as stage_counters:
+            for word in words:
+                word_count += 1
+                for name, predicate in stages:
+                    if not predicate(word):
+                        rejection_counts[name] += 1
+                        break
+                else:
+                    new_list_of_words.append(word)
+            stage_counters["items_in"] = word_count
+            stage_counters["items_out"] = len(new_list_of_words)
+
+        # The filters share a single pass, so only the pass as a whole is timed (as "filter_words").
+        # Each filter reports the words that reach it and pass it, with no wall time of its own
+        for name, rejected_count in rejection_counts.items():
+            self._instrumentation.add("filter " + name, calls=1, items_in=word_count, items_out=word_count - rejected_count)
+            word_count -= rejected_count
+        return new_list_of_words, rejection_counts
@@ -0,0 +1,190 @@
+from array import array
+from sqlite3 import connect
+from sys import intern
+from threading import Lock
+
+_LOCK_TIMEOUT = 30  # Seconds to wait for another process to release the database
+
+# The subject catalog is the same for every user, so it lives in its own shared database, attached as "catalog".
+# Bump the version whenever its schema or the meaning of the stored data changes. Older catalogs are then discarded
+_CATALOG_VERSION = 1
+_CATALOG_TABLES = ["subjects", "collections", "metadata"]
+_CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS catalog.subjects (
+    id              INTEGER PRIMARY KEY,
+    subject_type    TEXT NOT NULL,
+    characters      TEXT
+);
+CREATE INDEX IF NOT EXISTS catalog.subjects_by_type ON subjects (subject_type);
+
+CREATE TABLE IF NOT EXISTS catalog.collections (
+    collection_key          TEXT PRIMARY KEY,
+    updated_after           TEXT,
+    validated_updated_after TEXT,
+    etag                    TEXT,
+    last_modified           TEXT
+);
+
+CREATE TABLE IF NOT EXISTS catalog.metadata (
+    key     TEXT PRIMARY KEY,
+    value   TEXT
+);
+"""
+# Everything else belongs to a single user
+_USER_SCHEMA = """
+DROP TABLE IF EXISTS main.subjects;
+
+CREATE TABLE IF NOT EXISTS main.assignments (
+    subject_id      INTEGER PRIMARY KEY,
+    subject_type    TEXT NOT NULL,
+    srs_stage       INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS main.assignments_by_type_and_stage ON assignments (subject_type, srs_stage);
+
+CREATE TABLE IF NOT EXISTS main.collections (
+    collection_key          TEXT PRIMARY KEY,
+    updated_after           TEXT,
+    validated_updated_after TEXT,
+    etag                    TEXT,
+    last_modified           TEXT
+);
+
+CREATE TABLE IF NOT EXISTS main.metadata (
+    key     TEXT PRIMARY KEY,
+    value   TEXT
+);
+"""
+_COLLECTION_FIELDS = ["updated_after", "validated_updated_after", "etag", "last_modified"]
+_CATALOG_ENDPOINTS = ["subjects"]
+
+
+def _get_collection_schema(collection_key: str) -> str:
+    """
+    Finds the database that holds a collection's sync state
+    :param collection_key: key of the collection (endpoint + parameters)
+    :return: "catalog" for collections of the shared subject catalog, "main" for the user's own collections
+    """
+    endpoint = collection_key.split("?")[0]
+    return "catalog" if endpoint in _CATALOG_ENDPOINTS else "main"
+
+
+class WaniKaniCache:
+    def __init__(self, cache_file: str, catalog_file: str):
+        """
+        SQLite store for the user's assignments and the sync state of each collection,
+        with the shared subject catalog attached from its own database.
+        Changes are upserted row by row, so a sync only writes what it downloaded
+        :param cache_file: path of the user's SQLite database. Created if it doesn't exist
+        :param catalog_file: path of the SQLite database with the subject catalog shared by every user
+        """
+        # Other processes may use the same files: wait for their locks, and let readers run alongside a writer
+        self._connection = connect(cache_file, timeout=_LOCK_TIMEOUT, check_same_thread=False)
+        self._connection.execute("ATTACH DATABASE ? AS catalog", (catalog_file,))
+        self._connection.execute("PRAGMA main.journal_mode=WAL")
+        self._connection.execute("PRAGMA catalog.journal_mode=WAL")
+        self._lock = Lock()  # The connection is shared by the handler's download threads
+        with self._lock, self._connection:
+            catalog_version = self._connection.execute("PRAGMA catalog.user_version").fetchone()[0]
+            if catalog_version != _CATALOG_VERSION:
+                if catalog_version != 0:
+                    print("WaniKani subject catalog is from another version. Ignoring catalog contents.")
+                for table in _CATALOG_TABLES:
+                    self._connection.execute("DROP TABLE IF EXISTS catalog.%s" % table)
+                self._connection.execute("PRAGMA catalog.user_version = %d" % _CATALOG_VERSION)
+            self._connection.executescript(_CATALOG_SCHEMA + _USER_SCHEMA)
+
+
+    def get_collection(self, collection_key: str) -> dict:
+        """
+        Gets the sync state of a collection
+        :param collection_key: key of the collection (endpoint + parameters)
+        :return: Dictionary with the collection's updated_after timestamp and validators. Missing fields are left out
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT %s FROM %s.collections WHERE collection_key = ?" % (
+                    ", ".join(_COLLECTION_FIELDS), _get_collection_schema(collection_key)
+                ),
+                (collection_key,)
+            ).fetchone()
+        if row is None:
+            return {}
+        return {field: value for field, value in zip(_COLLECTION_FIELDS, row) if value is not None}
+
+
+    def get_catalog_refresh_time(self) -> str | None:
+        """
+        Gets the time the shared subject catalog was last refreshed
+        :return: Timestamp of the last refresh, or None if the catalog was never downloaded
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM catalog.metadata WHERE key = 'timestamp'").fetchone()
+        return None if row is None else row[0]
+
+
+    def write_changes(self, subjects: dict[str, dict[int, str]], assignments: dict[str, dict[int, int]],
+                      collections: dict[str, dict], timestamp: str) -> None:
+        """
+        Upserts a sync's changes in a single transaction
+        :param subjects: (subject_type : (subject_id : characters)) of the downloaded subjects. Empty if the catalog wasn't refreshed
+        :param assignments: (subject_type : (subject_id : srs_stage)) of the downloaded assignments
+        :param collections: (collection_key : sync state) of the crawled collections
+        :param timestamp: time of the sync
+        """
+        with self._lock, self._connection:
+            for subject_type, id_to_characters in subjects.items():
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO catalog.subjects (id, subject_type, characters) VALUES (?, ?, ?)",
+                    ((id, subject_type, characters) for id, characters in id_to_characters.items())
+                )
+            for subject_type, id_to_srs in assignments.items():
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO main.assignments (subject_id, subject_type, srs_stage) VALUES (?, ?, ?)",
+                    ((id, subject_type, srs_stage) for id, srs_stage in id_to_srs.items())
+                )
+            for collection_key, collection in collections.items():
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO %s.collections (collection_key, %s) VALUES (?, ?, ?, ?, ?)" % (
+                        _get_collection_schema(collection_key), ", ".join(_COLLECTION_FIELDS)
+                    ),
+                    [collection_key] + [collection.get(field) for field in _COLLECTION_FIELDS]
+                )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO main.metadata (key, value) VALUES ('timestamp', ?)",
+                (timestamp,)
+            )
+            if any(_get_collection_schema(collection_key) == "catalog" for collection_key in collections):
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO catalog.metadata (key, value) VALUES ('timestamp', ?)",
+                    (timestamp,)
+                )
+
+
+    def get_subjects(self, subject_type: str) -> tuple[array, list[str | None]]:
+        """
+        Loads the subject catalog of one type as parallel arrays sorted by subject id
+        :param subject_type: "kanji" or "vocabulary"
+        :return: Tuple of (array('I') of subject ids, list of the subjects' interned characters)
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, characters FROM catalog.subjects WHERE subject_type = ? ORDER BY id",
+                (subject_type,)
+            ).fetchall()
+        subject_ids = array("I", (row[0] for row in rows))
+        characters = [None if row[1] is None else intern(row[1]) for row in rows]
+        return subject_ids, characters
+
+
+    def get_assignments(self, subject_type: str) -> tuple[array, bytes]:
+        """
+        Loads the user's assignments of one type as parallel arrays sorted by subject id
+        :param subject_type: "kanji" or "vocabulary"
+        :return: Tuple of (array('I') of subject ids, bytes of the matching SRS stages)
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT subject_id, srs_stage FROM main.assignments WHERE subject_type = ? ORDER BY subject_id",
+                (subject_type,)
+            ).fetchall()
+        return array("I", (row[0] for row in rows)), bytes(row[1] for row in rows)
@@ -1,5 +1,18 @@
 from json import load, dump, decoder
 from datetime import datetime, timezone
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from hashlib import sha256
+from mmap import mmap, ACCESS_READ
+from os import path, stat, remove, replace, chmod, umask
+from struct import Struct
+from tempfile import mkstemp
+from threading import Lock
+from typing import IO, Iterator
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 _NLT_BLACKLISTED_WORD_TYPES = ["助詞", "助動詞", "動詞-接尾", "記号"]
 _NLT_DATABASE_FILE = "NLT1.40_freq_list.csv"
@@ -7,8 +20,18 @@ _BCCWJ_BLACKLISTED_WORD_TYPES = ["接尾辞"]
 _BCCWJ_DATABASE_FILE = "BCCWJ_frequencylist_suw_ver1_0.tsv"
 _BLACKLISTED_SYMBOLS = ["*", "％", "ｍ", "ｇ", "8", "【"]
 _FREQUENCY_LIST_FILE = "Frequency_List.json"
+# Binary copy of the frequency list: header, then (word count + 1) uint32 offsets, then the UTF-8 encoded words
+_FREQUENCY_LIST_BINARY_FILE = "Frequency_List.bin"
+_FREQUENCY_LIST_BINARY_HEADER = Struct("<4sII")  # magic, format version, word count
+_FREQUENCY_LIST_BINARY_MAGIC = b"WWFL"
+_FREQUENCY_LIST_BINARY_VERSION = 2  # 2 added the kanji signature of every word
+# Completed jpdb parse batches of an interrupted frequency list build
+_PARSE_CHECKPOINT_FILE = "Frequency_List_Checkpoint.json"
 
 _API_CONFIG_FILE = "config.json"
+_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+_UMASK = umask(0)  # umask can only be read by setting it, so it is read once here, before any other thread runs
+umask(_UMASK)
 KANA_LIST = [
     'ぁ', 'あ', 'ぃ', 'い', 'ぅ', 'う', 'ゔ', 'ぇ', 'え', 'ぉ', 'お', 'ゕ', 'か', 'が', 'き', 'ぎ', 'く', 'ぐ', 'ゖ', 'け', 'げ',
     'こ', 'ご', 'さ', 'ざ', 'し', 'じ', 'す', 'ず', 'せ', 'ぜ', 'そ', 'ぞ', 'た', 'だ', 'ち', 'ぢ', 'っ', 'つ', 'づ', 'て', 'で',
@@ -20,15 +43,40 @@ KANA_LIST = [
     'ボ', 'ポ', 'マ', 'ミ', 'ム', 'メ', 'モ', 'ャ', 'ヤ', 'ュ', 'ユ', 'ョ', 'ヨ', 'ラ', 'リ', 'ル', 'レ', 'ロ', 'ヮ', 'ワ', 'ヷ',
     'ヰ', 'ヸ', 'ヱ', 'ヹ', 'ヲ', 'ヺ', 'ン', '・', 'ー'
 ]
+KANA_SET = frozenset(KANA_LIST)
 
 
-def generate_frequency_list_file(jpdb_handler) -> None:
+def _read_bccwj_blacklist(line_limit: int) -> set[tuple[str, str]]:
     """
-    Generate a Frequency List file from the NLT database, and refine it with the BCCWJ database 
-    Excludes words of a blacklisted type or that contain a blacklisted symbol 
+    Reads the BCCWJ database into a blacklist of words with a blacklisted type
+    :param line_limit: Number of BCCWJ lines to read. Should be high enough to cover every word taken from NLT
+    :return: Set of blacklisted (lemma, reading) pairs
     """
-    # Generate initial list from NLT
-    list_of_entries = []
+    blacklisted_entries = set()
+    with open(_BCCWJ_DATABASE_FILE, "r", encoding='utf-8') as bccwj_database_file:
+        for line_count, line in enumerate(bccwj_database_file, start=1):
+            data = line.split('\t')
+            word_lemma = data[2].strip()
+            word_type = data[3].strip()
+            word_reading = data[1].strip()
+            # Add blacklisted words to set
+            for blacklisted_type in _BCCWJ_BLACKLISTED_WORD_TYPES:
+                if blacklisted_type in word_type:
+                    blacklisted_entries.add((word_lemma, word_reading))
+                    break
+            if line_count == line_limit:
+                break
+    return blacklisted_entries
+
+
+def _stream_nlt_words(blacklisted_entries: set[tuple[str, str]], word_limit: int) -> Iterator[str]:
+    """
+    Streams the words of the NLT database in frequency order, skipping blacklisted and duplicate words
+    :param blacklisted_entries: Set of (lemma, reading) pairs that should be skipped
+    :param word_limit: Number of candidate words to take from NLT, counted before the blacklist is applied
+    :return: Iterator of unique words in frequency order
+    """
+    seen_words = set()
     with open(_NLT_DATABASE_FILE, "r", encoding='utf-8') as nlt_database_file:
         word_count = 0
         for line in nlt_database_file:
@@ -42,70 +90,233 @@ def generate_frequency_list_file(jpdb_handler) -> None:
             # Remove blacklisted symbols
             for symbol in _BLACKLISTED_SYMBOLS:
                 if symbol in word_lemma:
-                    break  
+                    break
             else:
                 word_count += 1
-                list_of_entries.append((word_lemma, word_reading))
-            # Stop at ~50k words so it's not a huge file
-            if word_count == 51_000:
+                # Only pass words that don't match the blacklist from BCCWJ
+                if (word_lemma, word_reading) not in blacklisted_entries:
+                    # Remove the する part of "suru verbs"
+                    if word_lemma != "する" and word_lemma[-2:] == "する":
+                        word_lemma = word_lemma[:-2]
+                    # Finally pass the word on if not a duplicate
+                    if word_lemma not in seen_words:
+                        seen_words.add(word_lemma)
+                        yield word_lemma
+            if word_count == word_limit:
                 break
-    
-    # Generate blacklist from BCCWJ
-    list_of_blacklisted_entries = []
-    with open(_BCCWJ_DATABASE_FILE, "r", encoding='utf-8') as bccwj_database_file:
-        word_count = 0
-        for line in bccwj_database_file:
-            word_count += 1
-            data = line.split('\t')
-            word_lemma = data[2].strip()
-            word_type = data[3].strip()
-            word_reading = data[1].strip()
-            # Add blacklisted words to list
-            for blacklisted_type in _BCCWJ_BLACKLISTED_WORD_TYPES:
-                if blacklisted_type in word_type:
-                    list_of_blacklisted_entries.append((word_lemma, word_reading))
-                    break
-            # Stop at 70k to be reasonably sure all 50k from initial list are covered
-            if word_count == 70_000:
-                break
-    
-    # Only add words to final list if they don't match the blacklist from BCCWJ
-    list_of_words = []
-    for entry in list_of_entries:
-        word_lemma = entry[0]
-        for blacklisted_entry in list_of_blacklisted_entries:
-            # If candidate matches a blacklisted entry's lemma and reading, don't add it
-            if word_lemma == blacklisted_entry[0] and entry[1] == blacklisted_entry[1]:
-                break
-        else:
-            # # Remove the する part of "suru verbs"
-            if word_lemma != "する" and word_lemma[-2:] == "する":
-                word_lemma = word_lemma[:-2]
-            # Finally add to list if not a duplicate
-            if word_lemma not in list_of_words:
-                list_of_words.append(word_lemma)
-    
+
+
+def generate_frequency_list_file(jpdb_handler, nlt_word_limit: int = 51_000, bccwj_line_limit: int = 70_000,
+                                 batch_size: int = 1000, max_in_flight: int = 4) -> None:
+    """
+    Generate a Frequency List file from the NLT database, and refine it with the BCCWJ database 
+    Excludes words of a blacklisted type or that contain a blacklisted symbol 
+    :param nlt_word_limit: Number of candidate words to take from NLT (~50k so it's not a huge file)
+    :param bccwj_line_limit: Number of BCCWJ lines to read for the blacklist (70k to be reasonably sure all NLT words are covered)
+    :param batch_size: Number of words per jpdb parse request
+    :param max_in_flight: Maximum number of jpdb parse requests sent at once
+    """
+    blacklisted_entries = _read_bccwj_blacklist(bccwj_line_limit)
+    list_of_words = list(_stream_nlt_words(blacklisted_entries, nlt_word_limit))
+
     # Pass list through JPDB's word recognition system
-    vocabulary_ids_list = []
-    batch_size = 1000
-    # Pass words in batches to not overload API
-    for i in range(0, len(list_of_words), batch_size):
-        print("Batch: [%d, %d]" % (i, i+batch_size))
-        list_of_words_slice = list_of_words[i:i+batch_size]
-        # Only add if not already in a previous batch
-        for vocab in jpdb_handler._get_vocabulary_ids(list_of_words_slice):
-            if vocab not in vocabulary_ids_list:
-                vocabulary_ids_list.append(vocab)
+    vocabulary_ids_list = _parse_words_in_batches(jpdb_handler, list_of_words, batch_size, max_in_flight)
     list_of_words = jpdb_handler._get_vocabulary_spellings(vocabulary_ids_list)
 
     # Write output database file
     print("Writing File")
-    with open(_FREQUENCY_LIST_FILE, "w", encoding='utf-8') as frequency_list_file:
+    with atomic_open(_FREQUENCY_LIST_FILE, "w", encoding='utf-8') as frequency_list_file:
         dump(
             list_of_words,
             frequency_list_file,
             indent=0
         )
+    write_frequency_list_binary(list_of_words)
+    if path.exists(_PARSE_CHECKPOINT_FILE):
+        remove(_PARSE_CHECKPOINT_FILE)
+
+
+def _parse_words_in_batches(jpdb_handler, list_of_words: list[str], batch_size: int, max_in_flight: int) -> list[list]:
+    """
+    Passes the words through jpdb's parser in concurrent batches. Completed batches are checkpointed to disk,
+    so an interrupted build resumes where it left off
+    :param jpdb_handler: JPDBHandler used to call the parser
+    :param list_of_words: List of words in frequency order
+    :param batch_size: Number of words per parse request
+    :param max_in_flight: Maximum number of parse requests sent at once
+    :return: List of unique [vid, sid] pairs in the order they were first seen
+    """
+    # The checkpoint is only valid for the same words split into the same batches
+    checkpoint_key = sha256(("%d\n" % batch_size + "\n".join(list_of_words)).encode('utf-8')).hexdigest()
+    completed_batches = {}
+    try:
+        with open(_PARSE_CHECKPOINT_FILE, "r", encoding='utf-8') as checkpoint_file:
+            checkpoint = load(checkpoint_file)
+        if checkpoint["key"] == checkpoint_key:
+            completed_batches = {int(batch_start): batch for batch_start, batch in checkpoint["batches"].items()}
+            print("Resuming from checkpoint: %d batches already done" % len(completed_batches))
+    except (FileNotFoundError, decoder.JSONDecodeError, KeyError):
+        pass
+
+    batch_starts = [i for i in range(0, len(list_of_words), batch_size) if i not in completed_batches]
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        futures = {
+            executor.submit(jpdb_handler._get_vocabulary_ids, list_of_words[i:i+batch_size]): i
+            for i in batch_starts
+        }
+        first_error = None
+        for future in as_completed(futures):
+            batch_start = futures[future]
+            try:
+                completed_batches[batch_start] = future.result()
+            except Exception as e:  # Any error, e.g. a malformed response, still keeps the finished batches
+                if first_error is None:
+                    first_error = e
+                    for pending_future in futures:  # Don't send any more batches, but keep the ones already running
+                        pending_future.cancel()
+                continue
+            print("Batch: [%d, %d]" % (batch_start, batch_start+batch_size))
+            _write_parse_checkpoint(checkpoint_key, completed_batches)
+
+    if first_error is not None:
+        print("%d of %d batches are checkpointed. Run again to parse the rest." % (
+            len(completed_batches), len(range(0, len(list_of_words), batch_size))
+        ))
+        raise first_error
+
+    # Only add if not already in a previous batch
+    vocabulary_ids_list = []
+    seen_vocabulary_ids = set()
+    for batch_start in sorted(completed_batches):
+        for vocab in completed_batches[batch_start]:
+            if tuple(vocab) not in seen_vocabulary_ids:
+                seen_vocabulary_ids.add(tuple(vocab))
+                vocabulary_ids_list.append(vocab)
+    return vocabulary_ids_list
+
+
+def _write_parse_checkpoint(checkpoint_key: str, completed_batches: dict[int, list]) -> None:
+    """
+    Writes the completed parse batches to the checkpoint file
+    """
+    with atomic_open(_PARSE_CHECKPOINT_FILE, "w", encoding='utf-8') as checkpoint_file:
+        dump(
+            {
+                "key": checkpoint_key,
+                "batches": completed_batches
+            },
+            checkpoint_file
+        )
+
+
+def _get_string_offsets(encoded_strings: list[bytes]) -> array:
+    """
+    Builds the offsets of strings laid end to end, with a final offset at the end of the last string
+    :param encoded_strings: List of encoded strings
+    :return: array('I') of len(encoded_strings) + 1 offsets
+    """
+    offsets = array('I', [0])
+    for encoded_string in encoded_strings:
+        offsets.append(offsets[-1] + len(encoded_string))
+    if offsets.itemsize != 4:  # array('I') is 4 bytes on every platform we run on, but the format depends on it
+        raise OverflowError("Error! Unsupported platform for the binary frequency list.")
+    return offsets
+
+
+def write_frequency_list_binary(list_of_words: list[str]) -> None:
+    """
+    Writes the frequency list in the binary format, so the top words can be read without parsing the whole file.
+    Each word's kanji signature (its non-kana characters) is stored with it, for the KanjiSignatureIndex.
+    Layout: header, word offsets, signature offsets, words, signatures
+    :param list_of_words: List of words in frequency order
+    """
+    encoded_words = [word.encode('utf-8') for word in list_of_words]
+    encoded_signatures = ["".join(sorted(frozenset(word) - KANA_SET)).encode('utf-8') for word in list_of_words]
+
+    with atomic_open(_FREQUENCY_LIST_BINARY_FILE, "wb") as binary_file:
+        binary_file.write(_FREQUENCY_LIST_BINARY_HEADER.pack(
+            _FREQUENCY_LIST_BINARY_MAGIC,
+            _FREQUENCY_LIST_BINARY_VERSION,
+            len(encoded_words)
+        ))
+        binary_file.write(_get_string_offsets(encoded_words).tobytes())
+        binary_file.write(_get_string_offsets(encoded_signatures).tobytes())
+        binary_file.write(b"".join(encoded_words))
+        binary_file.write(b"".join(encoded_signatures))
+
+
+def _read_frequency_list_binary_section(signatures: bool, num_of_words: int = None) -> list[str]:
+    """
+    Reads the strings of the most frequent words from the memory-mapped binary frequency list.
+    Only the requested strings are decoded
+    :param signatures: read the words' kanji signatures instead of the words themselves
+    :param num_of_words: The number of words to retrieve. Reads the whole list if None
+    :return: List of up to num_of_words strings in frequency order
+    """
+    with open(_FREQUENCY_LIST_BINARY_FILE, "rb") as binary_file, mmap(binary_file.fileno(), 0, access=ACCESS_READ) as data:
+        magic, version, word_count = _FREQUENCY_LIST_BINARY_HEADER.unpack_from(data, 0)
+        if magic != _FREQUENCY_LIST_BINARY_MAGIC or version != _FREQUENCY_LIST_BINARY_VERSION:
+            raise ValueError("Error! Unrecognized binary frequency list format.")
+        if num_of_words is None or num_of_words > word_count:
+            num_of_words = word_count
+
+        offsets = array('I')
+        offsets_size = (word_count + 1) * offsets.itemsize
+        offsets_start = _FREQUENCY_LIST_BINARY_HEADER.size + (offsets_size if signatures else 0)
+        strings_start = _FREQUENCY_LIST_BINARY_HEADER.size + 2 * offsets_size
+        if signatures:  # The signatures follow the words, whose last offset is their total size
+            offsets.frombytes(data[offsets_start - offsets.itemsize:offsets_start])
+            strings_start += offsets.pop()
+        offsets.frombytes(data[offsets_start:offsets_start + (num_of_words + 1) * offsets.itemsize])
+        return [
+            data[strings_start + offsets[i]:strings_start + offsets[i + 1]].decode('utf-8')
+            for i in range(num_of_words)
+        ]
+
+
+def read_frequency_list_binary(num_of_words: int = None) -> list[str]:
+    """
+    Reads the most frequent words from the memory-mapped binary frequency list. Only the requested words are decoded
+    :param num_of_words: The number of words to retrieve. Reads the whole list if None
+    :return: List of up to num_of_words words in frequency order
+    """
+    return _read_frequency_list_binary_section(signatures=False, num_of_words=num_of_words)
+
+
+def read_kanji_signatures_binary(num_of_words: int = None) -> list[str]:
+    """
+    Reads the kanji signatures of the most frequent words from the memory-mapped binary frequency list
+    :param num_of_words: The number of words whose signatures to retrieve. Reads them all if None
+    :return: List of up to num_of_words strings of each word's non-kana characters, in frequency order
+    """
+    return _read_frequency_list_binary_section(signatures=True, num_of_words=num_of_words)
+
+
+def _is_frequency_list_binary_current() -> bool:
+    """
+    Checks that the binary frequency list exists, is in the current format and is newer than the JSON file
+    :return: True if the binary frequency list can be used as is
+    """
+    if not path.exists(_FREQUENCY_LIST_BINARY_FILE) or \
+            path.getmtime(_FREQUENCY_LIST_BINARY_FILE) < path.getmtime(_FREQUENCY_LIST_FILE):
+        return False
+    with open(_FREQUENCY_LIST_BINARY_FILE, "rb") as binary_file:
+        header = binary_file.read(_FREQUENCY_LIST_BINARY_HEADER.size)
+    if len(header) < _FREQUENCY_LIST_BINARY_HEADER.size:
+        return False
+    magic, version, _ = _FREQUENCY_LIST_BINARY_HEADER.unpack(header)
+    return magic == _FREQUENCY_LIST_BINARY_MAGIC and version == _FREQUENCY_LIST_BINARY_VERSION
+
+
+def _update_frequency_list_binary() -> None:
+    """
+    (Re)writes the binary frequency list from the JSON file if it is missing, in an older format or older than the JSON file
+    """
+    if _is_frequency_list_binary_current():
+        return
+    print("Writing binary frequency list...")
+    with open(_FREQUENCY_LIST_FILE, "r", encoding='utf-8') as frequency_list_file:
+        write_frequency_list_binary(load(frequency_list_file))
     
 
 def read_config_file() -> dict:
@@ -126,7 +337,7 @@ def read_config_file() -> dict:
 
 
 def write_config_file(api_keys_dict: dict) -> None:
-    with open(_API_CONFIG_FILE, "w", encoding='utf-8') as config_file:
+    with atomic_open(_API_CONFIG_FILE, "w", encoding='utf-8') as config_file:
         dump(
             api_keys_dict,
             config_file,
@@ -141,16 +352,200 @@ def generate_frequent_words(num_of_words: int) -> list[str]:
     :param num_of_words: The number of words to retrieve (e.g. 500 = the 500 most common words)
     :return: List of words in frequency order from the frequency list file
     """
-    with open(_FREQUENCY_LIST_FILE, "r", encoding='utf-8') as frequency_list_file:
-        words_list = load(frequency_list_file)
-        if len(words_list) < num_of_words:  # Cap up_to_frequency to the length of word_list
-            print("Frequency list doesn't contain %d words. Could only retrieve %d.", (num_of_words, len(words_list)))
-            return words_list
-        else:
-            return words_list[0:num_of_words]
+    words_list = _get_cached_frequency_list(count_lookup=True)
+    if len(words_list) < num_of_words:  # Cap up_to_frequency to the length of word_list
+        print("Frequency list doesn't contain %d words. Could only retrieve %d." % (num_of_words, len(words_list)))
+        return list(words_list)
+    else:
+        return list(words_list[0:num_of_words])
+
+
+_frequency_list_cache = (None, ())  # ((file mtime, file size) the list was loaded at, tuple of all words)
+_frequency_list_cache_info = {"hits": 0, "misses": 0}
+_frequency_list_cache_lock = Lock()
+
+
+def _get_cached_frequency_list(count_lookup: bool = False) -> tuple[str, ...]:
+    """
+    Returns the frequency list from the in-process cache, reloading it if the file has changed since it was cached.
+    Cached on the file's mtime and size
+    :param count_lookup: count the lookup in get_frequency_list_cache_info. Only generate_frequent_words does,
+                         so internal users of the list (e.g. the kanji signature index) don't distort the counts
+    :return: Tuple of all words in frequency order
+    """
+    global _frequency_list_cache
+    _update_frequency_list_binary()
+    file_stats = stat(_FREQUENCY_LIST_BINARY_FILE)
+    file_key = (file_stats.st_mtime_ns, file_stats.st_size)
+    with _frequency_list_cache_lock:
+        cached_file_key, words_list = _frequency_list_cache
+        cache_hit = cached_file_key == file_key
+        if not cache_hit:
+            words_list = tuple(read_frequency_list_binary())
+            _frequency_list_cache = (file_key, words_list)
+        if count_lookup:
+            _frequency_list_cache_info["hits" if cache_hit else "misses"] += 1
+    return words_list
+
+
+class KanjiSignatureIndex:
+    def __init__(self, words_list: tuple[str, ...], signatures_list: list[str] = None):
+        """
+        Index of the non-kana characters (kanji signature) of every word in the frequency list,
+        with an inverted index from each character to the words that use it
+        :param words_list: Words in frequency order
+        :param signatures_list: the stored signature of each word (see read_kanji_signatures_binary).
+                                Computed from the words if None
+        """
+        if signatures_list is None:
+            signatures_list = [frozenset(word) - KANA_SET for word in words_list]
+        self._word_ranks = {}
+        self._word_signatures = {}
+        self._character_to_words = {}
+        for rank, (word, signature) in enumerate(zip(words_list, signatures_list)):
+            signature = frozenset(signature)
+            self._word_ranks[word] = rank
+            self._word_signatures[word] = signature
+            for character in signature:
+                self._character_to_words.setdefault(character, []).append(word)
+
+
+    def get_newly_unlocked_words(self, known_characters: set[str], new_characters: set[str], num_of_words: int = None) -> list[str]:
+        """
+        Finds the words that became fully known by learning new kanji. Only looks at the words that use the new kanji
+        :param known_characters: Set of all known kanji, the new ones included
+        :param new_characters: Set of the newly learned kanji
+        :param num_of_words: Only consider the num_of_words most frequent words. Considers all words if None
+        :return: List of newly unlocked words in frequency order
+        """
+        candidate_words = set()
+        for character in new_characters:
+            candidate_words.update(self._character_to_words.get(character, []))
+        unlocked_words = [
+            word for word in candidate_words
+            if (num_of_words is None or self._word_ranks[word] < num_of_words)
+            and self._word_signatures[word] <= known_characters
+        ]
+        return sorted(unlocked_words, key=self._word_ranks.__getitem__)
+
+
+    def get_known_words(self, known_characters: frozenset[str]) -> frozenset[str]:
+        """
+        Finds every indexed word made only of known kanji. Kana-only words always count as known
+        :param known_characters: Set of all known kanji
+        :return: Set of the words whose kanji signature is in known_characters
+        """
+        return frozenset(word for word, signature in self._word_signatures.items() if signature <= known_characters)
+
+
+    def get_word_signatures(self) -> dict[str, frozenset[str]]:
+        """
+        Gives the kanji signature of every indexed word, for filters that check many words. Must not be modified
+        :return: Dictionary of (word : frozenset of its non-kana characters)
+        """
+        return self._word_signatures
+
+
+_kanji_signature_index_cache = (None, None)  # (frequency list tuple the index was built from, KanjiSignatureIndex)
+
+
+def get_kanji_signature_index() -> KanjiSignatureIndex:
+    """
+    Returns the kanji signature index of the current frequency list, rebuilding it only if the list was reloaded.
+    Keyed on the identity of the cached frequency list tuple, so it follows the same file checks without hashing 50k words.
+    Built from the signatures stored in the binary frequency list
+    :return: The KanjiSignatureIndex
+    """
+    global _kanji_signature_index_cache
+    words_list = _get_cached_frequency_list()
+    cached_words_list, kanji_signature_index = _kanji_signature_index_cache
+    if cached_words_list is not words_list:
+        signatures_list = read_kanji_signatures_binary()
+        if len(signatures_list) != len(words_list):  # The file was rewritten since the words were loaded
+            signatures_list = None
+        kanji_signature_index = KanjiSignatureIndex(words_list, signatures_list)
+        _kanji_signature_index_cache = (words_list, kanji_signature_index)
+    return kanji_signature_index
+
+
+def get_frequency_list_cache_info() -> dict[str, int]:
+    """
+    Reports how often generate_frequent_words was served from the in-process cache
+    :return: Dictionary with the cache's hit and miss counts
+    """
+    with _frequency_list_cache_lock:
+        return dict(_frequency_list_cache_info)
+
+def create_session(pool_size: int, max_retries: int, headers: dict[str, str] = None) -> Session:
+    """
+    Creates a requests Session that keeps its connections alive and retries failed requests with backoff.
+    Every method is retried, so requests that aren't idempotent need a session with max_retries=0.
+    Throttled (429) requests are left to the RateLimiter, which knows when the limit resets
+    :param pool_size: Maximum number of pooled connections kept per host
+    :param max_retries: Number of retries on 5xx responses before giving up
+    :param headers: Headers sent with every request made through the session
+    :return: The configured Session
+    """
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=0.5,
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=None,  # POST included, so sessions must only be used for idempotent requests
+        raise_on_status=False  # Let the handlers report the final error response themselves
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if headers is not None:
+        session.headers.update(headers)
+    return session
+
+
+@contextmanager
+def atomic_open(file_name: str, mode: str, encoding: str = None) -> Iterator[IO]:
+    """
+    Opens a temporary file next to file_name for writing, and moves it over file_name once it is written.
+    Readers and other processes never see a half-written file, and an error leaves the old file untouched.
+    The file keeps the permissions of the file it replaces, or gets the umask's default ones if it is new
+    :param file_name: path of the file to write
+    :param mode: "w" or "wb"
+    :param encoding: encoding of the file in text mode
+    :return: The temporary file, open for writing
+    """
+    file_descriptor, temporary_file_name = mkstemp(
+        dir=path.dirname(path.abspath(file_name)),
+        prefix=path.basename(file_name) + ".",
+        suffix=".tmp"
+    )
+    try:
+        with open(file_descriptor, mode, encoding=encoding) as temporary_file:
+            yield temporary_file
+        try:
+            file_mode = stat(file_name).st_mode & 0o777
+        except FileNotFoundError:
+            file_mode = 0o666 & ~_UMASK
+        chmod(temporary_file_name, file_mode)  # mkstemp creates the file readable by its owner only
+        replace(temporary_file_name, file_name)
+    except BaseException:
+        remove(temporary_file_name)
+        raise
+
+
+def get_token_hash(api_token: str) -> str:
+    """
+    Hashes an API token into a short name for that user's files, so the token itself never ends up in a file name
+    :param api_token: the API token
+    :return: First 16 hex digits of the token's SHA-256 hash
+    """
+    return sha256(api_token.encode('utf-8')).hexdigest()[:16]
+
 
 def get_time() -> str:
-    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    return datetime.now(timezone.utc).strftime(_TIME_FORMAT)
+
+def parse_time(timestamp: str) -> datetime:
+    return datetime.strptime(timestamp, _TIME_FORMAT).replace(tzinfo=timezone.utc)
 
 def print_list(words_list: list[str]) -> None:
     for word in words_list: